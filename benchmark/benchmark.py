@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+"""
+Benchmark for dbus-proxy-bms.
+
+Starts a private D-Bus session bus, runs a copy of the driver on it and measures:
+
+- startup time until the service name is registered on the bus
+- SetValue throughput for single writes and SetItems throughput for complete snapshots
+- latency from a write to the change signal (PropertiesChanged or ItemsChanged)
+- latency of GetItems and of GetValue on a subtree
+- RSS of the driver after the measurements
+
+The results are printed as JSON, so that they can be compared between versions. Runs on any Linux box
+with dbus-daemon, dbus-python and PyGObject installed, no Venus OS device is needed.
+
+Example:
+    python benchmark/benchmark.py --output results.json --set PUBLISH.coalesce_window=50
+"""
+
+import argparse
+import configparser
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import monotonic, sleep
+
+import dbus
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
+
+DRIVER_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "dbus-proxy-bms")
+DRIVER_NAME = "dbus-proxy-bms"
+DEVICE_INSTANCE = 100
+SERVICE_NAME = "com.victronenergy.battery.proxy_bms_%d" % DEVICE_INSTANCE
+BUSITEM = "com.victronenergy.BusItem"
+
+# a complete snapshot like a BMS writer would send it
+SNAPSHOT = {
+    "/Dc/0/Voltage": 53.2,
+    "/Dc/0/Current": -12.5,
+    "/Dc/0/Power": -665.0,
+    "/Dc/0/Temperature": 21.5,
+    "/InstalledCapacity": 280.0,
+    "/ConsumedAmphours": 42.0,
+    "/Capacity": 238.0,
+    "/Soc": 85.0,
+    "/TimeToGo": 68000,
+    "/Info/MaxChargeVoltage": 55.2,
+    "/Info/MaxChargeCurrent": 100.0,
+    "/Info/MaxDischargeCurrent": 150.0,
+    "/System/MinCellVoltage": 3.321,
+    "/System/MaxCellVoltage": 3.334,
+    "/System/MinVoltageCellId": "C3",
+    "/System/MaxVoltageCellId": "C11",
+    "/System/MinCellTemperature": 20.1,
+    "/System/MaxCellTemperature": 22.4,
+    "/System/NrOfCellsPerBattery": 16,
+}
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def p(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    return {
+        "count": len(samples),
+        "min_ms": round(samples[0] * 1000, 3),
+        "p50_ms": round(p(0.50) * 1000, 3),
+        "p90_ms": round(p(0.90) * 1000, 3),
+        "p99_ms": round(p(0.99) * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+def read_rss_kb(pid):
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return None
+
+
+class PrivateBus:
+    """
+    A dbus-daemon with a session bus configuration, that only lives as long as the benchmark.
+    """
+
+    def __init__(self):
+        self._process = subprocess.Popen(
+            ["dbus-daemon", "--session", "--nofork", "--print-address=1"],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        self.address = self._process.stdout.readline().strip()
+
+    def stop(self):
+        self._process.terminate()
+        self._process.wait()
+
+
+class Driver:
+    """
+    A copy of the driver with its own config.ini in a temporary folder, so that an existing
+    config.ini is never touched.
+    """
+
+    def __init__(self, address, settings):
+        self._folder = tempfile.mkdtemp(prefix="dbus-proxy-bms-benchmark-")
+        self.path = os.path.join(self._folder, DRIVER_NAME)
+        shutil.copytree(DRIVER_DIR, self.path, ignore=shutil.ignore_patterns("config.ini", "__pycache__"))
+
+        config = configparser.ConfigParser()
+        config.optionxform = str
+        config["DEFAULT"] = {
+            "logging": "ERROR",
+            "device_name": "Benchmark",
+            "device_instance": str(DEVICE_INSTANCE),
+        }
+        for key, value in settings.items():
+            section, option = key.split(".", 1)
+            if section != "DEFAULT" and not config.has_section(section):
+                config.add_section(section)
+            config.set(section, option, value)
+        with open(os.path.join(self.path, "config.ini"), "w") as f:
+            config.write(f)
+
+        env = dict(os.environ, DBUS_SESSION_BUS_ADDRESS=address)
+        self.started = monotonic()
+        self._process = subprocess.Popen([sys.executable, os.path.join(self.path, DRIVER_NAME + ".py")], env=env)
+        self.pid = self._process.pid
+
+    def stop(self):
+        self._process.terminate()
+        self._process.wait()
+        shutil.rmtree(self._folder, ignore_errors=True)
+
+
+class Benchmark:
+    def __init__(self, bus, iterations):
+        self.bus = bus
+        self.iterations = iterations
+        self.results = {}
+        self._received = None
+        self._expected = None
+
+        bus.add_signal_receiver(
+            self._properties_changed,
+            signal_name="PropertiesChanged",
+            dbus_interface=BUSITEM,
+            bus_name=SERVICE_NAME,
+            path_keyword="path",
+        )
+        bus.add_signal_receiver(
+            self._items_changed,
+            signal_name="ItemsChanged",
+            dbus_interface=BUSITEM,
+            bus_name=SERVICE_NAME,
+        )
+
+    def item(self, path):
+        return dbus.Interface(self.bus.get_object(SERVICE_NAME, path, introspect=False), BUSITEM)
+
+    def _properties_changed(self, changes, path=None):
+        if self._expected is None:
+            return
+        if path == self._expected[0] and "Value" in changes and changes["Value"] == self._expected[1]:
+            self._received = monotonic()
+
+    def _items_changed(self, items):
+        if self._expected is None:
+            return
+        changes = items.get(self._expected[0])
+        if changes is not None and changes.get("Value") == self._expected[1]:
+            self._received = monotonic()
+
+    def _wait_for_signal(self, timeout=5):
+        context = GLib.MainContext.default()
+        deadline = monotonic() + timeout
+        while self._received is None and monotonic() < deadline:
+            context.iteration(False) or sleep(0.0001)
+        return self._received
+
+    def _drain(self):
+        context = GLib.MainContext.default()
+        while context.iteration(False):
+            pass
+
+    def wait_for_service(self, driver, timeout=30):
+        deadline = monotonic() + timeout
+        while monotonic() < deadline:
+            if self.bus.name_has_owner(SERVICE_NAME):
+                self.results["startup_s"] = round(monotonic() - driver.started, 3)
+                return
+            sleep(0.005)
+        raise RuntimeError("%s did not appear on the bus within %d seconds" % (SERVICE_NAME, timeout))
+
+    def set_value_throughput(self):
+        item = self.item("/Dc/0/Current")
+        started = monotonic()
+        for i in range(self.iterations):
+            item.SetValue(dbus.Double(i / 10.0, variant_level=1))
+        elapsed = monotonic() - started
+        self.results["set_value_per_s"] = round(self.iterations / elapsed, 1)
+        self._drain()
+
+    def set_items_throughput(self):
+        root = self.item("/")
+        started = monotonic()
+        for i in range(self.iterations):
+            snapshot = dict(SNAPSHOT)
+            snapshot["/Dc/0/Current"] = i / 10.0
+            root.SetItems(snapshot)
+        elapsed = monotonic() - started
+        self.results["set_items_per_s"] = round(self.iterations / elapsed, 1)
+        self.results["set_items_paths_per_s"] = round(self.iterations * len(SNAPSHOT) / elapsed, 1)
+        self._drain()
+
+    def write_to_signal_latency(self):
+        item = self.item("/Dc/0/Voltage")
+        samples = []
+        for i in range(self.iterations):
+            value = 40.0 + i / 100.0
+            self._expected = ("/Dc/0/Voltage", value)
+            self._received = None
+            sent = monotonic()
+            item.SetValue(dbus.Double(value, variant_level=1))
+            received = self._wait_for_signal()
+            if received is not None:
+                samples.append(received - sent)
+        self._expected = None
+        self.results["write_to_signal"] = percentiles(samples)
+        self.results["write_to_signal_missed"] = self.iterations - len(samples)
+
+    def read_latency(self):
+        root = self.item("/")
+        alarms = self.item("/Alarms")
+        for name, call in (("get_items", root.GetItems), ("get_value_subtree", alarms.GetValue)):
+            samples = []
+            for i in range(self.iterations):
+                started = monotonic()
+                call()
+                samples.append(monotonic() - started)
+            self.results[name] = percentiles(samples)
+
+    def rss(self, driver):
+        self.results["rss_kb"] = read_rss_kb(driver.pid)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dbus-proxy-bms on a private D-Bus session bus")
+    parser.add_argument("--iterations", type=int, default=1000, help="number of calls per measurement")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="SECTION.key=value",
+        help="setting for the config.ini of the driver, can be given several times",
+    )
+    args = parser.parse_args()
+
+    settings = {}
+    for setting in args.set:
+        key, value = setting.split("=", 1)
+        settings[key.strip()] = value.strip()
+
+    DBusGMainLoop(set_as_default=True)
+
+    bus = PrivateBus()
+    driver = None
+    try:
+        driver = Driver(bus.address, settings)
+        benchmark = Benchmark(dbus.bus.BusConnection(bus.address), args.iterations)
+        benchmark.wait_for_service(driver)
+        # let the driver settle before measuring
+        sleep(1)
+        benchmark.set_value_throughput()
+        benchmark.set_items_throughput()
+        benchmark.write_to_signal_latency()
+        benchmark.read_latency()
+        benchmark.rss(driver)
+    finally:
+        if driver is not None:
+            driver.stop()
+        bus.stop()
+
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "iterations": args.iterations,
+        "settings": settings,
+        "results": benchmark.results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+"""
+Combines the values of several batteries (sources) into one virtual battery.
+
+Every aggregate keeps the last value of each source and a running result, so an incoming change
+only touches the aggregates that depend on the changed path. Sums, averages and the capacity
+weighted SoC are updated in O(1). Minimum and maximum are O(1) as well, unless the source that
+currently holds the extreme moves away from it, then the few sources are scanned again.
+"""
+
+
+class SumAggregate:
+    def __init__(self, path):
+        self.path = path
+        self.inputs = (path,)
+        self._values = {}
+        self._total = 0
+        self._count = 0
+
+    def set(self, source, path, value):
+        old = self._values.pop(source, None)
+        if old is not None:
+            self._total -= old
+            self._count -= 1
+        if value is not None:
+            self._values[source] = value
+            self._total += value
+            self._count += 1
+
+    def remove(self, source):
+        self.set(source, self.path, None)
+
+    def result(self):
+        if self._count == 0:
+            return {self.path: None}
+        return {self.path: self._total}
+
+
+class AverageAggregate(SumAggregate):
+    def result(self):
+        if self._count == 0:
+            return {self.path: None}
+        return {self.path: self._total / self._count}
+
+
+class MinAggregate:
+    """
+    Minimum across all sources. When `idpath` is given, the value of that path of the source that
+    holds the minimum is reported together with it, e.g. /System/MinVoltageCellId.
+    """
+
+    def __init__(self, path, idpath=None):
+        self.path = path
+        self.idpath = idpath
+        self.inputs = (path,) if idpath is None else (path, idpath)
+        self._values = {}
+        self._ids = {}
+        self._best = None
+
+    def _better(self, a, b):
+        return a < b
+
+    def set(self, source, path, value):
+        if path == self.idpath:
+            self._ids[source] = value
+            return
+
+        old = self._values.get(source)
+        if value is not None:
+            self._values[source] = value
+            if self._best is None or (self._best != source and self._better(value, self._values[self._best])):
+                self._best = source
+                return
+            if self._best != source or (old is not None and not self._better(old, value)):
+                # the extreme is not affected, or the source holding it even improved
+                return
+        else:
+            self._values.pop(source, None)
+            if self._best != source:
+                return
+
+        # the source holding the extreme moved away from it, find the new one
+        self._best = None
+        for s, v in self._values.items():
+            if self._best is None or self._better(v, self._values[self._best]):
+                self._best = s
+
+    def remove(self, source):
+        self._ids.pop(source, None)
+        self.set(source, self.path, None)
+
+    def extreme(self):
+        if self._best is None:
+            return None
+        return self._values[self._best]
+
+    def result(self):
+        r = {self.path: self.extreme()}
+        if self.idpath is not None:
+            r[self.idpath] = None if self._best is None else self._ids.get(self._best)
+        return r
+
+
+class MaxAggregate(MinAggregate):
+    def _better(self, a, b):
+        return a > b
+
+
+class LimitAggregate(MinAggregate):
+    """
+    The lowest limit of all sources multiplied by the number of sources, so that no battery
+    gets more than its own limit when the current is split evenly.
+    """
+
+    def result(self):
+        if self._best is None:
+            return {self.path: None}
+        return {self.path: self._values[self._best] * len(self._values)}
+
+
+class WeightedSocAggregate:
+    """
+    State of charge weighted by the installed capacity of each source. Sources without a known
+    capacity are not taken into account.
+    """
+
+    def __init__(self, path="/Soc", weightpath="/InstalledCapacity"):
+        self.path = path
+        self.weightpath = weightpath
+        self.inputs = (path, weightpath)
+        self._soc = {}
+        self._weight = {}
+        self._weighted = 0
+        self._total = 0
+
+    def _apply(self, source, sign):
+        soc = self._soc.get(source)
+        weight = self._weight.get(source)
+        if soc is not None and weight is not None:
+            self._weighted += sign * soc * weight
+            self._total += sign * weight
+
+    def set(self, source, path, value):
+        self._apply(source, -1)
+        if path == self.path:
+            self._soc[source] = value
+        else:
+            self._weight[source] = value
+        self._apply(source, 1)
+
+    def remove(self, source):
+        self._apply(source, -1)
+        self._soc.pop(source, None)
+        self._weight.pop(source, None)
+
+    def result(self):
+        if self._total <= 0:
+            return {self.path: None}
+        return {self.path: self._weighted / self._total}
+
+
+def default_aggregates(soc="min", current_limits="sum"):
+    """
+    Returns the aggregates for the paths of a battery service.
+
+    @param soc             "min" for the lowest SoC, "weighted" for the SoC weighted by the installed capacity
+    @param current_limits  "sum" to add the /Info/Max*Current limits, "min" for the lowest limit times the
+                           number of batteries
+    """
+    aggregates = [
+        SumAggregate("/Dc/0/Power"),
+        AverageAggregate("/Dc/0/Voltage"),
+        SumAggregate("/Dc/0/Current"),
+        AverageAggregate("/Dc/0/Temperature"),
+        SumAggregate("/InstalledCapacity"),
+        SumAggregate("/ConsumedAmphours"),
+        SumAggregate("/Capacity"),
+        MinAggregate("/TimeToGo"),
+        MaxAggregate("/Info/ChargeRequest"),
+        MinAggregate("/Info/MaxChargeVoltage"),
+        MinAggregate("/History/MinimumVoltage"),
+        MaxAggregate("/History/MaximumVoltage"),
+        MaxAggregate("/History/ChargeCycles"),
+        SumAggregate("/History/TotalAhDrawn"),
+        SumAggregate("/History/ChargedEnergy"),
+        SumAggregate("/History/DischargedEnergy"),
+        MinAggregate("/System/MinCellVoltage", "/System/MinVoltageCellId"),
+        MaxAggregate("/System/MaxCellVoltage", "/System/MaxVoltageCellId"),
+        MinAggregate("/System/MinCellTemperature", "/System/MinTemperatureCellId"),
+        MaxAggregate("/System/MaxCellTemperature", "/System/MaxTemperatureCellId"),
+        MaxAggregate("/System/NrOfCellsPerBattery"),
+        SumAggregate("/System/NrOfModulesOnline"),
+        SumAggregate("/System/NrOfModulesOffline"),
+        SumAggregate("/System/NrOfModulesBlockingCharge"),
+        SumAggregate("/System/NrOfModulesBlockingDischarge"),
+    ]
+
+    if soc == "weighted":
+        aggregates.append(WeightedSocAggregate())
+    else:
+        aggregates.append(MinAggregate("/Soc"))
+
+    for path in ("/Info/MaxChargeCurrent", "/Info/MaxDischargeCurrent"):
+        aggregates.append(LimitAggregate(path) if current_limits == "min" else SumAggregate(path))
+
+    # the worst alarm state of all batteries
+    for alarm in (
+        "LowVoltage",
+        "HighVoltage",
+        "LowSoc",
+        "HighChargeCurrent",
+        "HighDischargeCurrent",
+        "HighCurrent",
+        "CellImbalance",
+        "HighChargeTemperature",
+        "LowChargeTemperature",
+        "LowCellVoltage",
+        "LowTemperature",
+        "HighTemperature",
+        "FuseBlown",
+    ):
+        aggregates.append(MaxAggregate("/Alarms/" + alarm))
+
+    return aggregates
+
+
+class Aggregator:
+    """
+    Routes the changes of each source to the aggregates that depend on them and returns the new
+    results of only those aggregates. Paths without an aggregate are passed through unchanged,
+    so the last received value wins.
+    """
+
+    def __init__(self, aggregates):
+        self._aggregates = aggregates
+        self._dependencies = {}
+        self._sources = set()
+        for aggregate in aggregates:
+            for path in aggregate.inputs:
+                self._dependencies.setdefault(path, []).append(aggregate)
+
+    @property
+    def sources(self):
+        return self._sources
+
+    def update(self, source, changes):
+        self._sources.add(source)
+        result = {}
+        touched = {}
+        for path, value in changes.items():
+            aggregates = self._dependencies.get(path)
+            if aggregates is None:
+                result[path] = value
+                continue
+            for aggregate in aggregates:
+                aggregate.set(source, path, value)
+                touched[aggregate] = True
+
+        for aggregate in touched:
+            result.update(aggregate.result())
+        return result
+
+    def remove(self, source):
+        self._sources.discard(source)
+        result = {}
+        for aggregate in self._aggregates:
+            aggregate.remove(source)
+            result.update(aggregate.result())
+        return result
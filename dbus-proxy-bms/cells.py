@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+from array import array
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+NAN = float("nan")
+
+
+def pack_stats(values, count):
+    """
+    Computes the statistics of the first `count` values of an array("d") in one pass, NaN marks an unknown
+    value. Uses NumPy when it is installed.
+
+    @return tuple with min, index of min, max, index of max, sum and number of known values, or None
+            when no value is known
+    """
+    if numpy is not None and count > 0:
+        a = numpy.frombuffer(values, dtype=numpy.float64, count=count)
+        known = count - int(numpy.count_nonzero(numpy.isnan(a)))
+        if known == 0:
+            return None
+        lo = int(numpy.nanargmin(a))
+        hi = int(numpy.nanargmax(a))
+        return float(a[lo]), lo, float(a[hi]), hi, float(numpy.nansum(a)), known
+
+    lo = hi = None
+    total = 0.0
+    known = 0
+    for i in range(count):
+        v = values[i]
+        if v != v:
+            continue
+        if lo is None:
+            lo = hi = i
+        elif v < values[lo]:
+            lo = i
+        elif v > values[hi]:
+            hi = i
+        total += v
+        known += 1
+    if lo is None:
+        return None
+    return values[lo], lo, values[hi], hi, total, known
+
+
+class CellMonitor:
+    """
+    Keeps the cell voltages (/Voltages/Cell1..N) and optionally the cell temperatures (/Temperatures/Cell1..N)
+    in contiguous arrays and derives the pack values from them: minimum and maximum with the cell ID, sum,
+    average, difference and the /Alarms/CellImbalance state. The average is taken over the known cells. The
+    pack values are computed once per batch of changes, no matter how many cells changed.
+
+    @param imbalance_warning  cell voltage difference in V for a warning, 0 = disabled
+    @param imbalance_alarm    cell voltage difference in V for an alarm, 0 = disabled
+    @param max_count          largest number of cells, a larger number is limited to it
+    """
+
+    VOLTAGE_PATHS = (
+        "/System/MinCellVoltage",
+        "/System/MinVoltageCellId",
+        "/System/MaxCellVoltage",
+        "/System/MaxVoltageCellId",
+        "/Voltages/Sum",
+        "/Voltages/Average",
+        "/Voltages/Diff",
+    )
+    TEMPERATURE_PATHS = (
+        "/System/MinCellTemperature",
+        "/System/MinTemperatureCellId",
+        "/System/MaxCellTemperature",
+        "/System/MaxTemperatureCellId",
+    )
+
+    def __init__(self, temperatures=False, imbalance_warning=0, imbalance_alarm=0, max_count=128):
+        self.temperatures = temperatures
+        self.max_count = max_count
+        self.imbalance_warning = imbalance_warning
+        self.imbalance_alarm = imbalance_alarm
+        self.count = 0
+        # the number of cells that was asked for, count is limited to max_count
+        self.requested = 0
+        self._voltages = array("d")
+        self._temperatures = array("d")
+        self._index = {}
+        self._resized = False
+
+    def paths(self, count=None):
+        """
+        Returns the cell paths for `count` cells, by default for the current number of cells.
+        """
+        count = self.count if count is None else count
+        paths = ["/Voltages/Cell%d" % (i + 1) for i in range(count)]
+        if self.temperatures:
+            paths += ["/Temperatures/Cell%d" % (i + 1) for i in range(count)]
+        return paths
+
+    def resize(self, count):
+        """
+        Changes the number of cells. Returns the paths that have to be added and the paths that have to be removed.
+        """
+        self.requested = count
+        count = max(0, int(count or 0))
+        if count > self.max_count:
+            logging.warning("limiting the number of cells from %d to %d" % (count, self.max_count))
+            count = self.max_count
+        old = set(self.paths())
+        new = self.paths(count)
+
+        for cells in (self._voltages, self._temperatures):
+            if count > len(cells):
+                cells.extend([NAN] * (count - len(cells)))
+            else:
+                del cells[count:]
+        self.count = count
+        self._resized = True
+
+        self._index = {}
+        for i in range(count):
+            self._index["/Voltages/Cell%d" % (i + 1)] = (self._voltages, i)
+            if self.temperatures:
+                self._index["/Temperatures/Cell%d" % (i + 1)] = (self._temperatures, i)
+
+        return [p for p in new if p not in old], sorted(old.difference(new))
+
+    def set_imbalance_limits(self, imbalance_warning, imbalance_alarm):
+        """
+        Changes the limits of /Alarms/CellImbalance, all pack values are derived again with the next update.
+        """
+        self.imbalance_warning = imbalance_warning
+        self.imbalance_alarm = imbalance_alarm
+        self._resized = True
+
+    def _imbalance(self, diff):
+        if 0 < self.imbalance_alarm <= diff:
+            return 2
+        if 0 < self.imbalance_warning <= diff:
+            return 1
+        return 0
+
+    def update(self, changes):
+        """
+        Returns the pack values that are derived from the changed cells, all of them after a resize.
+        """
+        voltages = self._resized
+        temperatures = self._resized and self.temperatures
+        self._resized = False
+        for path, value in changes.items():
+            entry = self._index.get(path)
+            if entry is None:
+                continue
+            cells, i = entry
+            cells[i] = NAN if value is None else value
+            if cells is self._voltages:
+                voltages = True
+            else:
+                temperatures = True
+
+        result = {}
+        if voltages:
+            stats = pack_stats(self._voltages, self.count)
+            if stats is None:
+                result.update(dict.fromkeys(self.VOLTAGE_PATHS))
+            else:
+                lo, lo_cell, hi, hi_cell, total, known = stats
+                diff = hi - lo
+                result["/System/MinCellVoltage"] = lo
+                result["/System/MinVoltageCellId"] = "C%d" % (lo_cell + 1)
+                result["/System/MaxCellVoltage"] = hi
+                result["/System/MaxVoltageCellId"] = "C%d" % (hi_cell + 1)
+                result["/Voltages/Sum"] = round(total, 3)
+                result["/Voltages/Average"] = round(total / known, 3)
+                result["/Voltages/Diff"] = round(diff, 3)
+                result["/Alarms/CellImbalance"] = self._imbalance(diff)
+        if temperatures:
+            stats = pack_stats(self._temperatures, self.count)
+            if stats is None:
+                result.update(dict.fromkeys(self.TEMPERATURE_PATHS))
+            else:
+                lo, lo_cell, hi, hi_cell = stats[:4]
+                result["/System/MinCellTemperature"] = lo
+                result["/System/MinTemperatureCellId"] = "C%d" % (lo_cell + 1)
+                result["/System/MaxCellTemperature"] = hi
+                result["/System/MaxTemperatureCellId"] = "C%d" % (hi_cell + 1)
+        return result
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+from gi.repository import GLib
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+# watch descriptor, mask, cookie, length of the name that follows
+EVENT = struct.Struct("iIII")
+
+
+class ConfigWatcher:
+    """
+    Watches a file with inotify on the main loop and calls `callback` once the file was written and closed
+    or replaced, e.g. by an editor that saves to a temporary file and renames it. The directory is watched
+    instead of the file, so a replaced file is still seen. Several events within `delay` ms end up in one
+    call, so a file that is saved in several steps is only read once.
+    """
+
+    def __init__(self, filename, callback, delay=500):
+        self.filename = os.path.realpath(filename)
+        self.delay = delay
+        self._callback = callback
+        self._timer = None
+        directory, name = os.path.split(self.filename)
+        self._name = name.encode()
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        if libc.inotify_add_watch(self._fd, directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, os.strerror(error), directory)
+
+        GLib.io_add_watch(self._fd, GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._on_readable)
+        logging.info("watching %s for changes" % self.filename)
+
+    def _on_readable(self, fd, condition):
+        changed = False
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + EVENT.size <= len(data):
+                length = EVENT.unpack_from(data, offset)[3]
+                name = data[offset + EVENT.size : offset + EVENT.size + length].rstrip(b"\0")
+                offset += EVENT.size + length
+                if name == self._name:
+                    changed = True
+
+        if changed:
+            if self._timer is not None:
+                GLib.source_remove(self._timer)
+            self._timer = GLib.timeout_add(self.delay, self._on_timer)
+        return True
+
+    def _on_timer(self):
+        self._timer = None
+        self._callback()
+        return False
@@ -5,15 +5,30 @@ import platform
 import logging
 import sys
 import os
-from time import sleep, time
+from time import sleep, monotonic
 import json
 import configparser  # for config/ini file
 import _thread
 
 # import Victron Energy packages
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), "ext", "velib_python"))
-from vedbus import VeDbusService
+from vedbus import VeDbusService, ServiceContext
 from ve_utils import get_vrm_portal_id  
+from follower import BatteryFollower
+from aggregation import Aggregator, default_aggregates
+from freshness import FreshnessTracker
+from deadband import DeadbandFilter, parse_rule
+from ratelimit import SenderRateLimiter
+from stats import ProxyStats
+from watchdog import StallWatchdog, SamplingProfiler
+from snapshot import Snapshot
+from history import History, HistoryExport
+from derived import DerivedValues
+from cells import CellMonitor
+from mqtt_input import MqttInput
+from socket_input import SocketInput
+from modbus_input import ModbusInput, RegisterBlock
+from configwatch import ConfigWatcher
 
 
 # get values from config.ini file
@@ -21,6 +36,7 @@ try:
     config_file = (os.path.dirname(os.path.realpath(__file__))) + "/config.ini"
     if os.path.exists(config_file):
         config = configparser.ConfigParser()
+        config.optionxform = str  # keep the case of the keys, they can contain D-Bus paths
         config.read(config_file)
 
         #if config["MQTT"]["broker_address"] == "IP_ADDR_OR_FQDN":
@@ -61,8 +77,6 @@ else:
 
 # set variables
 connected = 0
-last_changed = 0
-last_updated = 0
 
 # formatting
 def _a(p, v):
@@ -92,6 +106,9 @@ def _v3(p, v):
 def _w(p, v):
     return str("%i" % v) + "W"
 
+def _kwh(p, v):
+    return str("%.2f" % v) + "kWh"
+
 
 battery_dict = {
     # general data
@@ -128,6 +145,8 @@ battery_dict = {
     "/History/MinimumVoltage": {"value": None, "textformat": _v},
     "/History/MaximumVoltage": {"value": None, "textformat": _v},
     "/History/TotalAhDrawn": {"value": None, "textformat": _ah},
+    "/History/ChargedEnergy": {"value": None, "textformat": _kwh},
+    "/History/DischargedEnergy": {"value": None, "textformat": _kwh},
     # system
     "/System/MinVoltageCellId": {"value": None, "textformat": _s},
     "/System/MinCellVoltage": {"value": None, "textformat": _v3},
@@ -202,6 +221,12 @@ battery_dict = {
     "/Distributor/D/Fuse/3/Alarms/Blown": {"value": None, "textformat": _n},
 }
 
+# Groups of paths that are only registered on the D-Bus while they are used. The key is the path holding the
+# number of groups in use, the value the prefixes of the groups in the order they are counted.
+sparse_groups = {
+    "/NrOfDistributors": ["/Distributor/A", "/Distributor/B", "/Distributor/C", "/Distributor/D"],
+}
+
 ignore_list = [
     "/FirmwareVersion",
     "/HardwareVersion",
@@ -225,6 +250,161 @@ ignore_list = [
     "/History/Clear",
 ]
 
+class PublishCoalescer(ServiceContext):
+    """
+    Collects the changes of all paths and emits them as one ItemsChanged signal on the root object,
+    instead of one PropertiesChanged signal per path.
+
+    The changes are flushed as soon as no new change was staged for `window` ms, but at the latest
+    `max_latency` ms after the first change was staged, so a writer that never pauses still gets
+    its values published.
+    """
+
+    def __init__(self, parent, window, max_latency):
+        ServiceContext.__init__(self, parent)
+        self.window = window
+        self.max_latency = max(window, max_latency)
+        self._timer = None
+        self._first_staged = 0
+        self._last_staged = 0
+        # number of changes staged and number of signals they were published with
+        self.staged = 0
+        self.flushes = 0
+
+    def stage(self, path, changes):
+        now = monotonic()
+        self.changes[path] = changes
+        self.staged += 1
+        self._last_staged = now
+        if self._timer is None:
+            self._first_staged = now
+            self._timer = GLib.timeout_add(self.window, self._on_timer)
+
+    def _on_timer(self):
+        now = monotonic()
+        quiet = (now - self._last_staged) * 1000
+        pending = (now - self._first_staged) * 1000
+        if quiet < self.window and pending < self.max_latency:
+            # still receiving changes, wait for the window to pass or the max latency to be reached
+            remaining = min(self.window - quiet, self.max_latency - pending)
+            self._timer = GLib.timeout_add(max(1, int(remaining)), self._on_timer)
+            return False
+        self._timer = None
+        self.flush()
+        return False
+
+    def flush(self):
+        if self._timer is not None:
+            GLib.source_remove(self._timer)
+            self._timer = None
+        if self.changes:
+            logging.debug("publishing %d changed paths" % len(self.changes))
+            self.flushes += 1
+            self.parent._dbusnodes["/"].ItemsChanged(self.changes)
+            self.changes.clear()
+
+
+class UpdateScheduler:
+    """
+    Calls `callback` after values changed, but not more often than every `min_interval` ms. When nothing
+    changed for `max_interval` ms it is called anyway as a heartbeat (0 = no heartbeat).
+    """
+
+    def __init__(self, callback, min_interval, max_interval):
+        self._callback = callback
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._last = monotonic()
+        self._pending = None
+        self._heartbeat = None
+        if max_interval > 0:
+            self._heartbeat = GLib.timeout_add(max_interval, self._on_heartbeat)
+
+    def set_intervals(self, min_interval, max_interval):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        if self._heartbeat is not None:
+            GLib.source_remove(self._heartbeat)
+            self._heartbeat = None
+        if max_interval > 0:
+            self._heartbeat = GLib.timeout_add(max_interval, self._on_heartbeat)
+
+    def changed(self):
+        if self._pending is not None:
+            return
+
+        # never call back right away, the changed value is not yet applied when this is called from an
+        # onchangecallback
+        wait = self.min_interval - (monotonic() - self._last) * 1000
+        if wait <= 0:
+            self._pending = GLib.idle_add(self._on_due)
+        else:
+            self._pending = GLib.timeout_add(int(wait) + 1, self._on_due)
+
+    def _on_due(self):
+        self._pending = None
+        self._run()
+        return False
+
+    def _run(self):
+        self._last = monotonic()
+        self._callback()
+
+    def _on_heartbeat(self):
+        idle = (monotonic() - self._last) * 1000
+        if idle >= self.max_interval:
+            self._run()
+            idle = 0
+        # wake up again when the heartbeat is due, counted from the last call
+        self._heartbeat = GLib.timeout_add(max(1, int(self.max_interval - idle)), self._on_heartbeat)
+        return False
+
+
+class SparseGroups:
+    """
+    Keeps track of the groups of paths that are only registered on the D-Bus while they are used, see
+    sparse_groups. The groups are added and removed when the controlling count path changes. A group
+    beyond the count is also added on the first write into it and removed again when all its paths
+    are invalidated.
+    """
+
+    def __init__(self, controls, paths):
+        self.controls = controls
+        self.active = set()
+        self._members = {}
+        self._group_of = {}
+        self._index = {}
+        self._count_path = {}
+
+        for count_path, groups in controls.items():
+            for index, group in enumerate(groups):
+                self._members[group] = []
+                self._index[group] = index
+                self._count_path[group] = count_path
+
+        for path in paths:
+            for group in self._members:
+                if path.startswith(group + "/"):
+                    self._members[group].append(path)
+                    self._group_of[path] = group
+                    break
+
+    def group_of(self, path):
+        return self._group_of.get(path)
+
+    def members(self, group):
+        return self._members[group]
+
+    def groups(self, count_path):
+        return self.controls[count_path]
+
+    def required(self, group, count):
+        return count is not None and self._index[group] < count
+
+    def count_path(self, group):
+        return self._count_path[group]
+
+
 class DbusMqttBatteryService:
     def __init__(
         self,
@@ -234,10 +414,37 @@ class DbusMqttBatteryService:
         productname="Proxy BMS",
         customname="Proxy BMS",
         connection="Proxy BMS service",
+        coalesce_window=0,
+        coalesce_max_latency=0,
+        signaltext=True,
+        sparse=True,
+        fallback=False,
+        update_min_interval=100,
+        update_max_interval=5000,
+        bus=None,
     ):
 
-        self._dbusservice = VeDbusService(servicename, register=False)
+        self._dbusservice = VeDbusService(
+            servicename, bus=bus, register=False, signaltext=signaltext, fallback=fallback
+        )
         self._paths = paths
+        self._follower = None
+        self._follower_paths = ()
+        self._aggregator = None
+        self._freshness = None
+        self._deadband = None
+        self._ratelimiter = None
+        self._stats = None
+        self._snapshot = None
+        self._history = None
+        self._history_export = None
+        self._derived = None
+        self._cells = None
+        self._written = {}
+        self._mqtt = None
+        self._socket = None
+        self._modbus = None
+        self._sparse = SparseGroups(sparse_groups if sparse else {}, paths)
 
         logging.debug("%s /DeviceInstance = %d" % (servicename, deviceinstance))
 
@@ -261,44 +468,942 @@ class DbusMqttBatteryService:
         self._dbusservice.add_path("/Latency", None)
 
         for path, settings in self._paths.items():
-            self._dbusservice.add_path(
-                path,
-                settings["value"],
-                gettextcallback=settings["textformat"],
-                writeable=True,
-                onchangecallback=self._handlechangedvalue,
-            )
+            # sparse groups are added when they are used
+            if self._sparse.group_of(path) is None:
+                self._add_battery_path(self._dbusservice, path)
 
         # register VeDbusService after all paths where added
         self._dbusservice.register()
+        self._dbusservice.missingpathcallback = self._missing_path
+        self._dbusservice.writecallback = self._path_written
 
-        GLib.timeout_add(1000, self._update)  # pause 1000ms before the next request
-
-    def _update(self):
-
-        global last_changed, last_updated
+        # collect the changes and publish them as one signal per window
+        if coalesce_window > 0:
+            self._dbusservice.publisher = PublishCoalescer(self._dbusservice, coalesce_window, coalesce_max_latency)
 
-        now = int(time())
+        # increment /UpdateIndex when new data arrived instead of polling
+        self._scheduler = UpdateScheduler(self._update, update_min_interval, update_max_interval)
 
-        if last_changed != last_updated:
+    def set_publishing(
+        self, coalesce_window, coalesce_max_latency, signaltext, update_min_interval, update_max_interval
+    ):
+        """
+        Changes the settings of [PUBLISH] that can be changed while the service is registered. Changes that are
+        held back by the coalescer are published before it is removed.
+        """
+        publisher = self._dbusservice.publisher
+        if coalesce_window > 0 and publisher is not None:
+            publisher.window = coalesce_window
+            publisher.max_latency = max(coalesce_window, coalesce_max_latency)
+        elif coalesce_window > 0:
+            self._dbusservice.publisher = PublishCoalescer(self._dbusservice, coalesce_window, coalesce_max_latency)
+        elif publisher is not None:
+            publisher.flush()
+            self._dbusservice.publisher = None
+        self._dbusservice.set_signal_text(signaltext)
+        self._scheduler.set_intervals(update_min_interval, update_max_interval)
 
-            last_updated = last_changed
+    def rename(self, customname):
+        self._dbusservice["/CustomName"] = customname
 
+    def _update(self):
         # increment UpdateIndex - to show that new data is available
         index = self._dbusservice["/UpdateIndex"] + 1  # increment index
         if index > 255:  # maximum value of the index
             index = 0  # overflow from 255 to 0
         self._dbusservice["/UpdateIndex"] = index
+
+    def _add_battery_path(self, service, path):
+        settings = self._paths[path]
+        service.add_path(
+            path,
+            settings["value"],
+            gettextcallback=settings["textformat"],
+            writeable=True,
+            onchangecallback=self._handlechangedvalue,
+        )
+
+    def set_values(self, changes):
+        """
+        Writes the values of an input, e.g. the follower, to the D-Bus. All changes end up in one signal.
+        """
+        if self._stats is None:
+            self._set_values(changes)
+            return
+        started = monotonic()
+        self._set_values(changes)
+        self._stats.took(monotonic() - started)
+
+    def _set_values(self, changes):
+        if (
+            self._cells is not None
+            and changes.get("/System/NrOfCellsPerBattery", self._cells.requested) != self._cells.requested
+        ):
+            with self._dbusservice as s:
+                self._resize_cells(s, changes["/System/NrOfCellsPerBattery"])
+
+        if self._derived is not None or self._cells is not None:
+            derived = self._derive_from(changes)
+            if derived:
+                changes = dict(changes)
+                changes.update(derived)
+
+        if self._freshness is not None:
+            for path, value in changes.items():
+                if path not in self._paths:
+                    continue
+                if value is None:
+                    self._freshness.forget(path)
+                else:
+                    self._freshness.touch(path)
+
+        with self._dbusservice as s:
+            touched = set()
+            for path, value in changes.items():
+                if path not in s:
+                    group = self._sparse.group_of(path)
+                    if group is None or value is None:
+                        continue
+                    self._add_group(s, group)
+                elif self._deadband is not None and not self._deadband.accept(path, value, s[path]):
+                    continue
+                s[path] = value
+                if self._history is not None and path in s.changes:
+                    self._history.record(path, value)
+                if self._snapshot is not None:
+                    self._persist(s, path, value)
+                if path in self._sparse.controls:
+                    self._resize_groups(s, path, value)
+                elif self._sparse.active:
+                    group = self._sparse.group_of(path)
+                    if group is not None and value is None:
+                        touched.add(group)
+
+            for group in touched:
+                self._remove_group_if_unused(s, group)
+
+            if s.changes:
+                self._scheduler.changed()
+
+    def _add_group(self, s, group):
+        logging.info("adding paths of %s" % group)
+        self._sparse.active.add(group)
+        for path in self._sparse.members(group):
+            self._add_battery_path(s, path)
+
+    def _remove_group(self, s, group):
+        logging.info("removing paths of %s" % group)
+        self._sparse.active.discard(group)
+        s.del_tree(group)
+
+    def _remove_group_if_unused(self, s, group):
+        if group not in self._sparse.active:
+            return
+        if self._sparse.required(group, s[self._sparse.count_path(group)]):
+            return
+        for path in self._sparse.members(group):
+            if s[path] is not None:
+                return
+        self._remove_group(s, group)
+
+    def _resize_groups(self, s, count_path, count):
+        for group in self._sparse.groups(count_path):
+            if self._sparse.required(group, count):
+                if group not in self._sparse.active:
+                    self._add_group(s, group)
+            elif group in self._sparse.active:
+                self._remove_group(s, group)
+
+    def _missing_path(self, path):
+        group = self._sparse.group_of(path)
+        if group is None:
+            return False
+        with self._dbusservice as s:
+            self._add_group(s, group)
         return True
 
+    def watch_freshness(self, timeout, timeouts):
+        """
+        Invalidate the paths that were not written again within their timeout and set /Connected to 0.
+        `timeouts` contains the timeouts of single paths or path prefixes, which override `timeout`.
+        When called again, the paths tracked so far start over with their new timeout, without timeouts
+        the tracking is stopped.
+        """
+        tracked = []
+        if self._freshness is not None:
+            tracked = self._freshness.stop()
+            self._freshness = None
+        if timeout <= 0 and not any(timeouts.values()):
+            return
+        self._freshness = FreshnessTracker(timeout, timeouts, self._paths_expired)
+        for path in tracked:
+            self._freshness.touch(path)
+
+    def filter_changes(self, rules):
+        """
+        Absorb changes that are smaller than the deadband of their path, see DeadbandFilter. When called
+        again, the values held back by the previous rules are checked against the new ones, without rules
+        the filter is removed.
+        """
+        held = self._deadband.stop() if self._deadband is not None else {}
+        self._deadband = DeadbandFilter(rules, self.set_values) if rules else None
+        if held:
+            self.set_values(held)
+
+    def limit_writers(self, rate, burst, flush_interval):
+        """
+        Limit the writes of each D-Bus sender, see SenderRateLimiter. The counters are published below
+        /Proxy/RateLimit, so that a misbehaving writer can be found. When called again, the limits are
+        changed and the counters are kept, a rate of 0 removes the limit and its paths.
+        """
+        if rate <= 0:
+            if self._ratelimiter is not None:
+                folded = self._ratelimiter.stop()
+                self._ratelimiter = None
+                if folded:
+                    self.set_values(folded)
+                with self._dbusservice as s:
+                    s.del_tree("/Proxy/RateLimit")
+            return
+        if self._ratelimiter is not None:
+            self._ratelimiter.rate = rate
+            self._ratelimiter.burst = max(1, burst)
+            self._ratelimiter.flush_interval = flush_interval
+            return
+        self._ratelimiter = SenderRateLimiter(rate, burst, flush_interval, self._apply_folded)
+        if "/Proxy/RateLimit/Folded" not in self._dbusservice:
+            self._dbusservice.add_path("/Proxy/RateLimit/Folded", 0)
+            self._dbusservice.add_path("/Proxy/RateLimit/Dropped", 0)
+            self._dbusservice.add_path("/Proxy/RateLimit/TopSender", None)
+
+    def publish_stats(self, interval):
+        """
+        Publish the counters of the proxy below /Proxy/Stats every `interval` ms, see ProxyStats.
+        """
+        self._stats = ProxyStats(self._dbusservice, interval)
+
+    def derive_values(self, outputs, tau):
+        """
+        Compute the `outputs` from voltage, current, SoC and capacity, see DerivedValues. When called
+        again, the outputs and the smoothing are changed without resetting the counters.
+        """
+        if not outputs:
+            self._derived = None
+        elif self._derived is not None:
+            self._derived.outputs = set(outputs)
+            self._derived.tau = tau
+        else:
+            self._derived = DerivedValues(self._dbusservice, outputs, tau)
+
+    def monitor_cells(self, temperatures, imbalance_warning, imbalance_alarm, max_cells=128):
+        """
+        Register /Voltages/Cell1..N (and /Temperatures/Cell1..N) for the number of cells in
+        /System/NrOfCellsPerBattery and derive the pack values from them, see CellMonitor. When called
+        again, only the imbalance limits are changed.
+        """
+        if self._cells is not None:
+            self._cells.set_imbalance_limits(imbalance_warning, imbalance_alarm)
+            self.set_values({})
+            return
+        self._cells = CellMonitor(temperatures, imbalance_warning, imbalance_alarm, max_cells)
+        with self._dbusservice as s:
+            for path in ("/Voltages/Sum", "/Voltages/Average", "/Voltages/Diff"):
+                self._paths[path] = {"value": None, "textformat": _v}
+                self._add_battery_path(s, path)
+            self._resize_cells(s, s["/System/NrOfCellsPerBattery"])
+
+    def _resize_cells(self, s, count):
+        added, removed = self._cells.resize(count)
+        logging.info("monitoring %d cells" % self._cells.count)
+        for path in removed:
+            s.del_tree(path)
+            del self._paths[path]
+            if self._freshness is not None:
+                self._freshness.forget(path)
+        for path in added:
+            self._paths[path] = {"value": None, "textformat": _v3 if path.startswith("/Voltages/") else _t}
+            self._add_battery_path(s, path)
+        for path, value in self._cells.update({}).items():
+            s[path] = value
+
+    def _derive_from(self, changes):
+        derived = {}
+        if self._cells is not None:
+            derived.update(self._cells.update(changes))
+        if self._derived is not None:
+            derived.update(self._derived.update(changes))
+        return derived
+
+    def _derive(self, path, value):
+        # the values derived from all paths written by one SetItems call are computed and applied together
+        if not self._written:
+            GLib.idle_add(self._apply_derived)
+        self._written[path] = value
+
+    def _apply_derived(self):
+        written, self._written = self._written, {}
+        derived = self._derive_from(written)
+        if derived:
+            self.set_values(derived)
+        return False
+
+    def record_history(self, paths, size, typecode):
+        """
+        Keep the last `size` changes of the paths, they can be queried with GetHistory on /Proxy/History.
+        """
+        self._history = History(paths, size, typecode)
+        self._history_export = HistoryExport(self._dbusservice.dbusconn, self._history)
+
+    def persist(self, snapshot):
+        """
+        Keep the values of the paths selected by the snapshot in its file and restore them now. The number
+        of restored values that were not written again since is published in /Proxy/Snapshot/Stale.
+        """
+        self._dbusservice.add_path("/Proxy/Snapshot/Stale", 0)
+        values = snapshot.load()
+        if values:
+            logging.info("restoring %d values from %s" % (len(values), snapshot.filename))
+            self.set_values(values)
+        self._snapshot = snapshot
+        self._dbusservice["/Proxy/Snapshot/Stale"] = len(snapshot.stale)
+
+    def _persist(self, s, path, value):
+        if self._snapshot.update(path, value):
+            s["/Proxy/Snapshot/Stale"] = len(self._snapshot.stale)
+
+    def _apply_folded(self, changes):
+        self.set_values(changes)
+        with self._dbusservice as s:
+            s["/Proxy/RateLimit/Folded"] = self._ratelimiter.folded
+            s["/Proxy/RateLimit/Dropped"] = self._ratelimiter.dropped
+            s["/Proxy/RateLimit/TopSender"] = self._ratelimiter.top_sender()
+
+    def _path_written(self, path, value, sender):
+        # called for every value another process wrote with SetValue or SetItems
+        if self._stats is None:
+            return self._accept_write(path, value, sender)
+        started = monotonic()
+        accepted = self._accept_write(path, value, sender)
+        self._stats.took(monotonic() - started)
+        self._stats.written(accepted)
+        return accepted
+
+    def _accept_write(self, path, value, sender):
+        if self._freshness is not None:
+            self._freshness.touch(path)
+            if self._follower is None and self._dbusservice["/Connected"] == 0:
+                self._dbusservice["/Connected"] = 1
+
+        # the derived values integrate every sample, also the ones that are folded or absorbed below
+        if self._derived is not None or self._cells is not None:
+            self._derive(path, value)
+
+        if self._ratelimiter is not None and not self._ratelimiter.allow(sender, path, value):
+            return False  # folded, applied later with the latest value
+
+        current = self._dbusservice[path]
+        if self._deadband is not None and not self._deadband.accept(path, value, current):
+            return False  # absorbed, keep the current value
+
+        if value != current:
+            self._scheduler.changed()
+            if self._history is not None:
+                self._history.record(path, value)
+        if self._snapshot is not None:
+            self._persist(self._dbusservice, path, value)
+        # the count is applied right after this returned, the paths that depend on it are changed now, so
+        # that the paths written together with it in one SetItems call already exist
+        if path in self._sparse.controls:
+            with self._dbusservice as s:
+                self._resize_groups(s, path, value)
+        elif path == "/System/NrOfCellsPerBattery" and self._cells is not None and value != self._cells.requested:
+            with self._dbusservice as s:
+                self._resize_cells(s, value)
+        return True
+
+    def _paths_expired(self, paths):
+        logging.warning("no new values received in time, invalidating %s" % ", ".join(sorted(paths)))
+        changes = dict.fromkeys(paths)
+        changes["/Connected"] = 0
+        self.set_values(changes)
+
+    def follow(self, services, mapping, aggregator=None):
+        """
+        Mirror the values of the upstream battery services instead of waiting for an external writer.
+        `mapping` translates the upstream paths to the own paths. With an `aggregator` the values of
+        all upstream services are combined into one virtual battery.
+        """
+        self._follower_paths = set(mapping.values())
+        self._aggregator = aggregator
+        self._dbusservice["/Connected"] = 0
+        self._follower = BatteryFollower(
+            self._dbusservice.dbusconn,
+            services,
+            mapping,
+            self._upstream_changed,
+            self._upstream_removed,
+            ownname=self._dbusservice.name,
+        )
+
+    def remap(self, mapping):
+        """
+        Replace the mapping of the follower, the paths that are no longer mapped are invalidated.
+        """
+        if self._follower is None:
+            return
+        removed = self._follower_paths.difference(mapping.values())
+        self._follower_paths = set(mapping.values())
+        self._follower.set_mapping(mapping)
+        if removed:
+            self.set_values(dict.fromkeys(removed))
+
+    def remap_mqtt(self, mapping):
+        """
+        Replace the mapping of the MQTT input.
+        """
+        if self._mqtt is not None:
+            self._mqtt.set_mapping(mapping)
+
+    def subscribe(self, broker, port, topics, mapping, **kwargs):
+        """
+        Take the values from the JSON documents on the MQTT topics, see MqttInput. `mapping` translates the
+        JSON keys to the own paths.
+        """
+        self._mqtt = MqttInput(broker, port, topics, mapping, self._input_changed, **kwargs)
+
+    def listen(self, filename, paths):
+        """
+        Take the values from binary frames on a Unix datagram socket, see SocketInput. The ID of a path is
+        its index in `paths`.
+        """
+        types = {}
+        for path in paths:
+            textformat = self._paths[path]["textformat"]
+            if textformat is _n:
+                types[path] = int
+            elif textformat is not _s:
+                types[path] = float
+        self._socket = SocketInput(filename, paths, types, self._input_changed)
+
+    def poll_modbus(self, host, port, unit, blocks, timeout):
+        """
+        Take the values from the register blocks of a Modbus-TCP device, see ModbusInput.
+        """
+        self._modbus = ModbusInput(host, port, unit, blocks, self._input_changed, timeout)
+
+    def _input_changed(self, changes):
+        # valid values of an input show that the battery is connected again, after the paths expired
+        if self._follower is None and any(value is not None for value in changes.values()):
+            changes = dict(changes)
+            changes["/Connected"] = 1
+        self.set_values(changes)
+
+    def _upstream_changed(self, servicename, changes):
+        if self._aggregator is not None:
+            changes = self._aggregator.update(servicename, changes)
+
+        changes["/Connected"] = 1
+        self.set_values(changes)
+
+    def _upstream_removed(self, servicename):
+        if self._aggregator is not None:
+            changes = self._aggregator.remove(servicename)
+        else:
+            changes = {}
+
+        if self._follower.services:
+            self.set_values(changes)
+            return
+
+        logging.warning("no upstream battery service left, invalidating values")
+        changes = dict.fromkeys(self._follower_paths)
+        changes["/Connected"] = 0
+        self.set_values(changes)
+
     def _handlechangedvalue(self, path, value):
         logging.debug("someone else updated %s to %s" % (path, value))
+        if path == "/System/NrOfCellsPerBattery" and self._cells is not None:
+            if isinstance(value, (int, float)) and value > self._cells.max_count:
+                logging.warning("rejecting %s = %s, more than %d cells" % (path, value, self._cells.max_count))
+                return False
+        elif value is None and self._sparse.group_of(path) is not None:
+            # the value is set after this callback returned, so check afterwards if the group is still used
+            GLib.idle_add(self._remove_unused_group, self._sparse.group_of(path))
         return True  # accept the change
 
+    def _remove_unused_group(self, group):
+        with self._dbusservice as s:
+            self._remove_group_if_unused(s, group)
+        return False
+
+
+class InstanceConfig:
+    """
+    The settings of one instance. In the multi instance mode the section [instance:N] overrides the
+    [DEFAULT] settings of instance N and a section [NAME:N] overrides single settings of [NAME]. When
+    path tables like [DEADBAND] are read with items(), [NAME:N] replaces [NAME] completely. Without an
+    instance all settings are taken from the config as they are.
+    """
+
+    def __init__(self, config, instance=None):
+        self._config = config
+        self.instance = instance
+
+    def _own(self, section):
+        if self.instance is None:
+            return None
+        own = "instance:%s" % self.instance if section == "DEFAULT" else "%s:%s" % (section, self.instance)
+        return own if self._config.has_section(own) else None
+
+    def _lookup(self, getter, section, option, fallback):
+        own = self._own(section)
+        if own is not None and self._config.has_option(own, option):
+            return getter(own, option)
+        return getter(section, option, fallback=fallback)
+
+    def overrides(self, section, option):
+        """
+        Returns True when the setting is overridden for this instance.
+        """
+        own = self._own(section)
+        return own is not None and self._config.has_option(own, option)
+
+    def get(self, section, option, fallback=None):
+        if section == "DEFAULT" and option == "device_instance" and self.instance is not None:
+            return self.instance
+        return self._lookup(self._config.get, section, option, fallback)
+
+    def getint(self, section, option, fallback=None):
+        return self._lookup(self._config.getint, section, option, fallback)
+
+    def getfloat(self, section, option, fallback=None):
+        return self._lookup(self._config.getfloat, section, option, fallback)
+
+    def getboolean(self, section, option, fallback=None):
+        return self._lookup(self._config.getboolean, section, option, fallback)
+
+    def has_section(self, section):
+        return self._own(section) is not None or self._config.has_section(section)
+
+    def items(self, section):
+        return self._config.items(self._own(section) or section)
+
+    def defaults(self):
+        return self._config.defaults()
+
+    def sections(self):
+        """
+        Returns the names of all sections, without the instance suffix.
+        """
+        names = {"DEFAULT"}
+        for section in self._config.sections():
+            if not section.startswith("instance:"):
+                names.add(section.split(":", 1)[0])
+        return names
+
+    def section(self, section):
+        """
+        Returns the raw settings of a section as dict to compare it with another config. The [DEFAULT] settings
+        are only contained in the DEFAULT section.
+        """
+        defaults = self._config.defaults()
+        values = dict(defaults) if section == "DEFAULT" else {}
+        for name in (section, self._own(section)):
+            if name is None or not self._config.has_section(name):
+                continue
+            for option, value in self._config.items(name, raw=True):
+                if section == "DEFAULT" or defaults.get(option) != value:
+                    values[option] = value
+        return values
+
+
+def get_staleness(settings):
+    """
+    Returns the default timeout and the timeouts of single paths or path prefixes from [STALENESS].
+    """
+    timeouts = {}
+    if settings.has_section("STALENESS"):
+        for path, timeout in settings.items("STALENESS"):
+            if path.startswith("/"):
+                timeouts[path] = float(timeout)
+    return settings.getfloat("STALENESS", "timeout", fallback=0), timeouts
+
+
+def get_deadband_rules(settings):
+    """
+    Returns the deadband rules of the paths and path prefixes in [DEADBAND].
+    """
+    rules = {}
+    if settings.has_section("DEADBAND"):
+        for path, rule in settings.items("DEADBAND"):
+            if path.startswith("/"):
+                rules[path] = parse_rule(rule)
+    return rules
+
+
+def get_derived_paths(settings):
+    """
+    Returns the paths in [DERIVED] that can be derived.
+    """
+    derived = [p.strip() for p in settings.get("DERIVED", "paths", fallback="").split(",") if p.strip()]
+    for path in derived:
+        if path not in DerivedValues.OUTPUTS:
+            logging.warning('ignoring "%s" in [DERIVED], it cannot be derived' % path)
+    return [p for p in derived if p in DerivedValues.OUTPUTS]
+
+
+def get_follower_mapping(settings):
+    """
+    Returns the upstream path -> own path mapping for the follower mode. All paths of battery_dict are
+    mirrored 1:1, the [FOLLOWER_PATHS] section can remap or disable (empty value) single paths.
+    """
+    mapping = {path: path for path in battery_dict}
+
+    if settings.has_section("FOLLOWER_PATHS"):
+        for upstream, path in settings.items("FOLLOWER_PATHS"):
+            if not upstream.startswith("/"):
+                continue
+            path = path.strip()
+            if path == "":
+                mapping.pop(upstream, None)
+            elif path in battery_dict:
+                mapping[upstream] = path
+            else:
+                logging.warning('ignoring follower mapping "%s = %s", unknown path' % (upstream, path))
+
+    return mapping
+
+
+def get_mqtt_mapping(settings):
+    """
+    Returns the JSON key -> own path mapping for the MQTT input. The keys follow the JSON format of
+    dbus-mqtt-battery, e.g. "Dc/Voltage" for /Dc/0/Voltage and "Voltages/*" for all cell voltages. The
+    [MQTT_PATHS] section can remap or disable (empty value) single keys.
+    """
+    mapping = {}
+    for path in battery_dict:
+        key = path[1:]
+        if key.startswith("Dc/0/"):
+            key = "Dc/" + key[5:]
+        mapping[key] = path
+    mapping["Voltages/*"] = "/Voltages/*"
+    mapping["Temperatures/*"] = "/Temperatures/*"
+
+    if settings.has_section("MQTT_PATHS"):
+        for key, path in settings.items("MQTT_PATHS"):
+            if key in settings.defaults():
+                continue
+            path = path.strip()
+            if path == "":
+                mapping.pop(key, None)
+            else:
+                mapping[key] = path
+
+    return mapping
+
+
+def get_modbus_blocks(settings):
+    """
+    Returns the register blocks of the Modbus-TCP input from the [MODBUS_BLOCKS] and [MODBUS_PATHS] sections.
+    """
+    fields = {}
+    for path, field in settings.items("MODBUS_PATHS") if settings.has_section("MODBUS_PATHS") else ():
+        if not path.startswith("/"):
+            continue
+        parts = [p.strip() for p in field.split(",")]
+        scale = float(parts[3]) if len(parts) > 3 else 1
+        fields.setdefault(parts[0], []).append((path, int(parts[1], 0), parts[2], scale))
+
+    blocks = []
+    for name, block in settings.items("MODBUS_BLOCKS") if settings.has_section("MODBUS_BLOCKS") else ():
+        if name in settings.defaults():
+            continue
+        if name not in fields:
+            logging.warning("ignoring Modbus block %s, no paths are mapped to it" % name)
+            continue
+        function, start, count, interval = [p.strip() for p in block.split(",")]
+        blocks.append(RegisterBlock(name, function, int(start, 0), int(count), int(interval), fields.pop(name)))
+
+    for name in fields:
+        logging.warning("ignoring the paths mapped to the unknown Modbus block %s" % name)
+    return blocks
+
+
+def start_instance(settings, bus=None):
+    """
+    Creates the battery service of one instance with all inputs and filters enabled in its settings.
+    """
+    paths_dbus = {
+        "/UpdateIndex": {"value": 0, "textformat": _n},
+    }
+    paths_dbus.update(battery_dict)
+
+    fallback = settings.getboolean("PUBLISH", "fallback_export", fallback=False)
+    sparse = settings.getboolean("PUBLISH", "sparse_groups", fallback=fallback)
+    if sparse and not fallback:
+        logging.info("a SetValue into a distributor fails until it is registered by /NrOfDistributors or SetItems")
+
+    battery = DbusMqttBatteryService(
+        servicename="com.victronenergy.battery.proxy_bms_" + str(settings.get("DEFAULT", "device_instance")),
+        deviceinstance=int(settings.get("DEFAULT", "device_instance")),
+        customname=settings.get("DEFAULT", "device_name"),
+        paths=paths_dbus,
+        bus=bus,
+        coalesce_window=settings.getint("PUBLISH", "coalesce_window", fallback=0),
+        coalesce_max_latency=settings.getint("PUBLISH", "coalesce_max_latency", fallback=0),
+        signaltext=settings.getboolean("PUBLISH", "signal_text", fallback=True),
+        sparse=sparse,
+        fallback=fallback,
+        update_min_interval=settings.getint("PUBLISH", "update_min_interval", fallback=100),
+        update_max_interval=settings.getint("PUBLISH", "update_max_interval", fallback=5000),
+    )
+
+    timeout, timeouts = get_staleness(settings)
+    if timeout > 0 or any(timeouts.values()):
+        battery.watch_freshness(timeout, timeouts)
+
+    rate = settings.getfloat("RATELIMIT", "rate", fallback=0)
+    if rate > 0:
+        battery.limit_writers(
+            rate,
+            settings.getint("RATELIMIT", "burst", fallback=int(rate)),
+            settings.getint("RATELIMIT", "flush_interval", fallback=250),
+        )
+
+    stats_interval = settings.getint("STATS", "interval", fallback=0)
+    if stats_interval > 0:
+        battery.publish_stats(stats_interval)
+
+    rules = get_deadband_rules(settings)
+    if rules:
+        battery.filter_changes(rules)
+
+    derived = get_derived_paths(settings)
+    if derived:
+        battery.derive_values(derived, settings.getfloat("DERIVED", "time_to_go_smoothing", fallback=60))
+
+    if settings.getboolean("CELLS", "enabled", fallback=False):
+        battery.monitor_cells(
+            settings.getboolean("CELLS", "temperatures", fallback=False),
+            settings.getfloat("CELLS", "imbalance_warning", fallback=0),
+            settings.getfloat("CELLS", "imbalance_alarm", fallback=0),
+            settings.getint("CELLS", "max_cells", fallback=128),
+        )
+
+    history_size = settings.getint("HISTORY", "samples", fallback=0)
+    if history_size > 0:
+        battery.record_history(
+            [
+                p.strip()
+                for p in settings.get(
+                    "HISTORY",
+                    "paths",
+                    fallback="/Dc/0/Voltage, /Dc/0/Current, /Soc, /System/MinCellVoltage, /System/MaxCellVoltage",
+                ).split(",")
+                if p.strip()
+            ],
+            history_size,
+            "d" if settings.get("HISTORY", "precision", fallback="float") == "double" else "f",
+        )
+
+    if settings.getboolean("SNAPSHOT", "enabled", fallback=False):
+        battery.persist(
+            Snapshot(
+                settings.get(
+                    "SNAPSHOT",
+                    "file",
+                    fallback=os.path.join(
+                        os.path.dirname(os.path.realpath(__file__)),
+                        "snapshot.json" if settings.instance is None else "snapshot_%s.json" % settings.instance,
+                    ),
+                ),
+                [
+                    p.strip()
+                    for p in settings.get(
+                        "SNAPSHOT", "paths", fallback="/Info, /History, /InstalledCapacity, /Capacity, /ConsumedAmphours"
+                    ).split(",")
+                    if p.strip()
+                ],
+                settings.getint("SNAPSHOT", "interval", fallback=300),
+                settings.getint("SNAPSHOT", "debounce", fallback=5000),
+            )
+        )
+
+    follower_services = [s.strip() for s in settings.get("FOLLOWER", "services", fallback="").split(",") if s.strip()]
+    if follower_services:
+        aggregator = None
+        if settings.getboolean("AGGREGATION", "enabled", fallback=False):
+            aggregator = Aggregator(
+                default_aggregates(
+                    soc=settings.get("AGGREGATION", "soc", fallback="min"),
+                    current_limits=settings.get("AGGREGATION", "current_limits", fallback="sum"),
+                )
+            )
+        battery.follow(follower_services, get_follower_mapping(settings), aggregator)
+
+    broker = settings.get("MQTT", "broker_address", fallback="").strip()
+    if broker:
+        battery.subscribe(
+            broker,
+            settings.getint("MQTT", "broker_port", fallback=1883),
+            [t.strip() for t in settings.get("MQTT", "topic", fallback="mqtt/battery").split(",") if t.strip()],
+            get_mqtt_mapping(settings),
+            username=settings.get("MQTT", "username", fallback="") or None,
+            password=settings.get("MQTT", "password", fallback="") or None,
+            tls=settings.getboolean("MQTT", "tls_enabled", fallback=False),
+            client_id="dbus-proxy-bms_" + str(settings.get("DEFAULT", "device_instance")),
+        )
+
+    socket_file = settings.get("SOCKET", "path", fallback="").strip()
+    if socket_file and settings.instance is not None and not settings.overrides("SOCKET", "path"):
+        # binding the socket replaces an existing one, so every instance needs its own
+        name, extension = os.path.splitext(socket_file)
+        socket_file = "%s_%s%s" % (name, settings.instance, extension)
+    if socket_file:
+        battery.listen(socket_file, list(battery_dict))
+
+    modbus_host = settings.get("MODBUS", "host", fallback="").strip()
+    if modbus_host:
+        battery.poll_modbus(
+            modbus_host,
+            settings.getint("MODBUS", "port", fallback=502),
+            settings.getint("MODBUS", "unit", fallback=1),
+            get_modbus_blocks(settings),
+            settings.getint("MODBUS", "timeout", fallback=2000),
+        )
+
+    return battery
+
+
+def _reconfigure_section(battery, section, changed, new):
+    """
+    Applies the changed settings of one section to a running instance. Returns the changed settings that
+    are only applied after a restart.
+    """
+    if section == "DEFAULT":
+        if "device_name" in changed:
+            battery.rename(new.get("DEFAULT", "device_name"))
+        # the logging level is set for the whole process when the config is read
+        changed -= {"device_name", "logging"}
+    elif section == "PUBLISH":
+        battery.set_publishing(
+            new.getint("PUBLISH", "coalesce_window", fallback=0),
+            new.getint("PUBLISH", "coalesce_max_latency", fallback=0),
+            new.getboolean("PUBLISH", "signal_text", fallback=True),
+            new.getint("PUBLISH", "update_min_interval", fallback=100),
+            new.getint("PUBLISH", "update_max_interval", fallback=5000),
+        )
+        changed &= {"sparse_groups", "fallback_export"}
+    elif section == "STALENESS":
+        battery.watch_freshness(*get_staleness(new))
+        changed.clear()
+    elif section == "DEADBAND":
+        battery.filter_changes(get_deadband_rules(new))
+        changed.clear()
+    elif section == "RATELIMIT":
+        rate = new.getfloat("RATELIMIT", "rate", fallback=0)
+        battery.limit_writers(
+            rate,
+            new.getint("RATELIMIT", "burst", fallback=int(rate)),
+            new.getint("RATELIMIT", "flush_interval", fallback=250),
+        )
+        changed.clear()
+    elif section == "DERIVED":
+        battery.derive_values(get_derived_paths(new), new.getfloat("DERIVED", "time_to_go_smoothing", fallback=60))
+        changed.clear()
+    elif section == "CELLS":
+        changed &= {"enabled", "temperatures", "max_cells"}
+        if not changed and new.getboolean("CELLS", "enabled", fallback=False):
+            battery.monitor_cells(
+                new.getboolean("CELLS", "temperatures", fallback=False),
+                new.getfloat("CELLS", "imbalance_warning", fallback=0),
+                new.getfloat("CELLS", "imbalance_alarm", fallback=0),
+            )
+    elif section == "FOLLOWER_PATHS":
+        battery.remap(get_follower_mapping(new))
+        changed.clear()
+    elif section == "MQTT_PATHS":
+        battery.remap_mqtt(get_mqtt_mapping(new))
+        changed.clear()
+    return changed
+
+
+def reconfigure(battery, old, new):
+    """
+    Applies the settings that changed between the configs `old` and `new` to a running instance. Only the
+    filters and paths of the changed settings are touched, the service stays registered and keeps its
+    values. Changes that can only be applied by a restart are logged.
+
+    @return False when the changes of a section could not be applied
+    """
+    applied = True
+    for section in sorted(old.sections() | new.sections()):
+        before = old.section(section)
+        after = new.section(section)
+        changed = {o for o in set(before) | set(after) if before.get(o) != after.get(o)}
+        if not changed:
+            continue
+        logging.info("applying the changed settings of [%s]: %s" % (section, ", ".join(sorted(changed))))
+
+        try:
+            restart = _reconfigure_section(battery, section, changed, new)
+        except (ValueError, KeyError, configparser.Error) as e:
+            logging.error("could not apply the changed settings of [%s]: %s" % (section, e))
+            applied = False
+            continue
+        if restart:
+            logging.warning(
+                "the changes of %s in [%s] are applied after a restart" % (", ".join(sorted(restart)), section)
+            )
+    return applied
+
+
+def get_instances(config):
+    return [section.split(":", 1)[1] for section in config.sections() if section.startswith("instance:")]
+
+
+def reload_config(batteries, applied):
+    """
+    Reads the config.ini again after it changed and applies the changes to the running instances, see
+    reconfigure(). An invalid config.ini is ignored and the previous settings are kept.
+
+    @param applied  dict with the config each instance runs with. It is only replaced when all changes
+                    could be applied, otherwise the next reload tries the changes that are left again.
+    """
+    global config
+
+    new = configparser.ConfigParser()
+    new.optionxform = str
+    try:
+        if not new.read(config_file):
+            logging.error("could not read %s, keeping the previous settings" % config_file)
+            return
+    except configparser.Error as e:
+        logging.error("ignoring the changed %s: %s" % (config_file, e))
+        return
+    logging.info("%s changed" % config_file)
+
+    level = new.get("DEFAULT", "logging", fallback="WARNING")
+    logging.getLogger().setLevel(level if level in ("DEBUG", "INFO", "ERROR") else "WARNING")
+
+    instances = get_instances(new)
+    if instances != [instance for instance, battery in batteries if instance is not None]:
+        logging.warning("instances are only added or removed after a restart")
+
+    for instance, battery in batteries:
+        if instance is not None and instance not in instances:
+            continue
+        if reconfigure(battery, InstanceConfig(applied[instance], instance), InstanceConfig(new, instance)):
+            applied[instance] = new
+        else:
+            logging.error("not all changes were applied, they are tried again when %s changes" % config_file)
+    config = new
+
 
 def main():
     _thread.daemon = True  # allow the program to quit
 
+    import dbus
     from dbus.mainloop.glib import (
         DBusGMainLoop,
     )  # pyright: ignore[reportMissingImports]
@@ -306,17 +1411,39 @@ def main():
     # Have a mainloop, so we can send/receive asynchronous calls to and from dbus
     DBusGMainLoop(set_as_default=True)
 
-    paths_dbus = {
-        "/UpdateIndex": {"value": 0, "textformat": _n},
-    }
-    paths_dbus.update(battery_dict)
+    batteries = []
+    instances = get_instances(config)
+    if instances:
+        # every instance exports the same object paths, so each one needs its own connection
+        for instance in instances:
+            logging.info("starting instance %s" % instance)
+            if "DBUS_SESSION_BUS_ADDRESS" in os.environ:
+                bus = dbus.SessionBus(private=True)
+            else:
+                bus = dbus.SystemBus(private=True)
+            batteries.append((instance, start_instance(InstanceConfig(config, instance), bus)))
+    else:
+        batteries.append((None, start_instance(InstanceConfig(config))))
 
-    DbusMqttBatteryService(
-        servicename="com.victronenergy.battery.proxy_bms_" + str(config["DEFAULT"]["device_instance"]),
-        deviceinstance=int(config["DEFAULT"]["device_instance"]),
-        customname=config["DEFAULT"]["device_name"],
-        paths=paths_dbus,
-    )
+    if config.getboolean("RELOAD", "enabled", fallback=True):
+        try:
+            applied = {instance: config for instance, battery in batteries}
+            ConfigWatcher(
+                config_file, lambda: reload_config(batteries, applied), config.getint("RELOAD", "delay", fallback=500)
+            )
+        except (OSError, AttributeError) as e:
+            logging.warning("cannot watch %s for changes: %s" % (config_file, e))
+
+    stall_threshold = config.getint("WATCHDOG", "stall_threshold", fallback=0)
+    if stall_threshold > 0:
+        profiler = None
+        if config.getboolean("WATCHDOG", "profile", fallback=False):
+            profiler = SamplingProfiler(
+                config.getint("WATCHDOG", "profile_interval", fallback=10),
+                config.getint("WATCHDOG", "profile_report_interval", fallback=300),
+                config.get("WATCHDOG", "profile_file", fallback="/data/log/dbus-proxy-bms-profile.txt"),
+            )
+        StallWatchdog(stall_threshold, profiler=profiler)
 
     logging.info("Connected to dbus and switching over to GLib.MainLoop() (= event based)")
     mainloop = GLib.MainLoop()
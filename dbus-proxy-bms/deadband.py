@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+from gi.repository import GLib
+import logging
+from time import monotonic
+
+
+def parse_rule(text):
+    """
+    Parses a deadband rule like "0.01", "0.5%", "0.01, 30" or "0.5%, 60".
+
+    @return tuple with the absolute deadband, the relative deadband and the max hold time in seconds
+    """
+    parts = [p.strip() for p in text.split(",")]
+    band = parts[0]
+    hold = float(parts[1]) if len(parts) > 1 and parts[1] != "" else 0
+    if band.endswith("%"):
+        return 0, float(band[:-1]) / 100, hold
+    return float(band), 0, hold
+
+
+class DeadbandFilter:
+    """
+    Absorbs changes that are smaller than the deadband of a path, so that jitter in the last digit does
+    not cause a signal. A change is compared with the last published value, not with the previous
+    change, so slow drifts are still published once they add up to the deadband.
+
+    When a max hold time is set, an absorbed value is published anyway once the last published value
+    is older than the max hold time.
+
+    @param rules     dict with a path or path prefix as key and a tuple as returned by parse_rule as
+                     value, the longest matching prefix wins
+    @param callback  function that is called with a dict of the held values that are due
+    """
+
+    def __init__(self, rules, callback):
+        self._rules = sorted(rules.items(), key=lambda r: len(r[0]), reverse=True)
+        self._callback = callback
+        self._rule_of = {}
+        self._published = {}
+        self._pending = {}
+        self._timer = None
+        self._due = None
+
+    def _rule_for(self, path):
+        try:
+            return self._rule_of[path]
+        except KeyError:
+            rule = None
+            for prefix, r in self._rules:
+                if path == prefix or path.startswith(prefix.rstrip("/") + "/"):
+                    rule = r
+                    break
+            self._rule_of[path] = rule
+            return rule
+
+    def accept(self, path, value, current):
+        """
+        Returns True when the value has to be published, False when it is absorbed.
+        """
+        rule = self._rule_for(path)
+        if rule is None:
+            return True
+
+        absolute, relative, hold = rule
+        now = monotonic()
+
+        if (
+            value is None
+            or current is None
+            or isinstance(value, bool)
+            or not isinstance(value, (int, float))
+            or not isinstance(current, (int, float))
+            or abs(value - current) >= max(absolute, relative * abs(current))
+            or (hold > 0 and now - self._published.get(path, 0) >= hold)
+        ):
+            self._published[path] = now
+            self._pending.pop(path, None)
+            return True
+
+        if value != current:
+            self._pending[path] = value
+            # a value that is due before the armed timer needs an earlier one
+            if hold > 0 and (self._timer is None or self._published.get(path, 0) + hold < self._due):
+                self._arm(now)
+        return False
+
+    def stop(self):
+        """
+        Cancels the timer and returns the held values that were not published yet.
+        """
+        if self._timer is not None:
+            GLib.source_remove(self._timer)
+            self._timer = None
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def _arm(self, now):
+        if self._timer is not None:
+            GLib.source_remove(self._timer)
+            self._timer = None
+        due = None
+        for path in self._pending:
+            hold = self._rule_for(path)[2]
+            if hold > 0:
+                t = self._published.get(path, 0) + hold
+                due = t if due is None else min(due, t)
+        if due is not None:
+            self._due = due
+            self._timer = GLib.timeout_add(max(1, int((due - now) * 1000)), self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        now = monotonic()
+        changes = {}
+        for path, value in list(self._pending.items()):
+            hold = self._rule_for(path)[2]
+            if hold > 0 and now - self._published.get(path, 0) >= hold:
+                changes[path] = value
+                del self._pending[path]
+
+        if changes:
+            logging.debug("publishing held values %s" % changes)
+            self._callback(changes)
+        if self._pending and self._timer is None:
+            self._arm(now)
+        return False
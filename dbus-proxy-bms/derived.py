@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+from math import exp
+from time import monotonic
+
+
+class DerivedValues:
+    """
+    Derives the values a BMS often does not provide from voltage, current, SoC and capacity:
+
+    - /Dc/0/Power from voltage times current
+    - /ConsumedAmphours and /History/TotalAhDrawn by integrating the current, both are negative like
+      the values of the Victron battery monitors
+    - /History/ChargedEnergy and /History/DischargedEnergy in kWh by integrating the power
+    - /TimeToGo in seconds from the remaining capacity and the smoothed discharge current
+
+    The integration uses the trapezoidal rule between two samples. A value is only computed when one of
+    its inputs changed. The counters continue from the current value of their path, e.g. one that was
+    restored from a snapshot.
+
+    @param values   mapping with the current values of the paths, to continue the counters from
+    @param outputs  the paths that are derived
+    @param tau      time constant in seconds of the current smoothing for /TimeToGo
+    """
+
+    INPUTS = ("/Dc/0/Voltage", "/Dc/0/Current", "/Soc", "/Capacity", "/InstalledCapacity")
+    OUTPUTS = (
+        "/Dc/0/Power",
+        "/ConsumedAmphours",
+        "/TimeToGo",
+        "/History/TotalAhDrawn",
+        "/History/ChargedEnergy",
+        "/History/DischargedEnergy",
+    )
+
+    # no integration over gaps longer than this in seconds, e.g. when the writer was gone
+    MAX_GAP = 60
+    # discharge current in A below which the battery counts as idle and /TimeToGo is infinite
+    IDLE_CURRENT = 0.1
+
+    def __init__(self, values, outputs, tau=60):
+        self._values = values
+        self.outputs = set(outputs)
+        self.tau = tau
+        self._inputs = dict.fromkeys(self.INPUTS)
+        self._last = None
+        self._smoothed = None
+        self._counters = {}
+
+    def update(self, changes):
+        """
+        Returns the derived values that changed because of the changes.
+        """
+        touched = False
+        for path in self.INPUTS:
+            if path in changes:
+                self._inputs[path] = changes[path]
+                touched = True
+        if not touched:
+            return {}
+
+        result = {}
+        voltage = self._inputs["/Dc/0/Voltage"]
+        current = self._inputs["/Dc/0/Current"]
+
+        if "/Dc/0/Voltage" in changes or "/Dc/0/Current" in changes:
+            power = voltage * current if voltage is not None and current is not None else None
+            if "/Dc/0/Power" in self.outputs:
+                result["/Dc/0/Power"] = power
+            self._integrate(monotonic(), current, power, result)
+
+        if "/TimeToGo" in self.outputs:
+            result["/TimeToGo"] = self._time_to_go()
+
+        return result
+
+    def _integrate(self, now, current, power, result):
+        last = self._last
+        self._last = None if current is None else (now, current, power)
+        if current is None:
+            self._smoothed = None
+            return
+        if last is None:
+            self._smoothed = current
+            return
+
+        dt = now - last[0]
+        if dt <= 0 or dt > self.MAX_GAP:
+            return
+
+        self._smoothed += (current - self._smoothed) * (1 - exp(-dt / self.tau))
+
+        amphours = (last[1] + current) / 2 * dt / 3600
+        self._count(result, "/ConsumedAmphours", amphours, ceiling=0)
+        if amphours < 0:
+            self._count(result, "/History/TotalAhDrawn", amphours)
+
+        if power is not None and last[2] is not None:
+            kwh = (last[2] + power) / 2 * dt / 3600000
+            if kwh > 0:
+                self._count(result, "/History/ChargedEnergy", kwh)
+            else:
+                self._count(result, "/History/DischargedEnergy", -kwh)
+
+    def _count(self, result, path, delta, ceiling=None):
+        if path not in self.outputs:
+            return
+        value = self._counters.get(path)
+        if value is None:
+            value = self._values[path] or 0
+        value += delta
+        if ceiling is not None and value > ceiling:
+            value = ceiling
+        self._counters[path] = value
+        result[path] = round(value, 3)
+
+    def _time_to_go(self):
+        if self._smoothed is None or self._smoothed > -self.IDLE_CURRENT:
+            return None
+
+        remaining = self._inputs["/Capacity"]
+        if remaining is None:
+            soc = self._inputs["/Soc"]
+            installed = self._inputs["/InstalledCapacity"]
+            if soc is None or installed is None:
+                return None
+            remaining = soc / 100 * installed
+        return int(remaining / -self._smoothed * 3600)
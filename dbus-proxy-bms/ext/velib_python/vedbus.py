@@ -2,10 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import dbus.service
+from dbus.lowlevel import SignalMessage
 import logging
 import traceback
 import os
 import weakref
+from bisect import bisect_left, insort
 from collections import defaultdict
 from ve_utils import wrap_dbus_value, unwrap_dbus_value
 
@@ -13,6 +15,8 @@ from ve_utils import wrap_dbus_value, unwrap_dbus_value
 # VeDbusItemImport -> use this to read data from the dbus, ie import
 # VeDbusItemExport -> use this to export data to the dbus (one value)
 # VeDbusService -> use that to create a service and export several values to the dbus
+# VeDbusFallbackRootExport + VeDbusItemFallback -> alternative to one dbus object per path,
+#	see the fallback parameter of VeDbusService
 
 # Code for VeDbusItemImport is copied from busitem.py and thereafter modified.
 # All projects that used busitem.py need to migrate to this package. And some
@@ -58,14 +62,41 @@ from ve_utils import wrap_dbus_value, unwrap_dbus_value
 
 # Export ourselves as a D-Bus service.
 class VeDbusService(object):
-	def __init__(self, servicename, bus=None, register=True):
+	# @param fallback	when True, one fallback object on / answers the calls for all paths instead
+	#					of registering a dbus object for every path and every node in between.
+	def __init__(self, servicename, bus=None, register=True, signaltext=True, fallback=False):
 		# dict containing the VeDbusItemExport objects, with their path as the key.
 		self._dbusobjects = {}
 		self._dbusnodes = {}
+		# sorted list with the paths of _dbusobjects, so that all paths below a node can be found
+		# without going through all objects, see _subtree
+		self._sortedpaths = []
 		self._ratelimiters = []
 		self._dbusname = None
 		self.name = servicename
 
+		# Optional ServiceContext that collects the changes of all items, instead of each item
+		# emitting its own PropertiesChanged signal. Whoever sets it is responsible for flushing it.
+		self.publisher = None
+
+		# Whether the change signals contain the text of the value. When False the text is only
+		# rendered when someone asks for it with GetText or GetItems.
+		self._signaltext = signaltext
+
+		# Optional function that is called with the path when SetItems, or SetValue in the fallback mode, writes
+		# a path that does not exist.
+		# It may add the path with add_path and return True, then the value is written as usual.
+		self.missingpathcallback = None
+
+		# Optional function that is called with the path, the value and the unique bus name of the sender
+		# every time another process wrote a value with SetValue or SetItems that was accepted, also when
+		# the value did not change. It is called before the value is applied, return False to keep the
+		# current value. The write is still reported as successful.
+		self.writecallback = None
+
+		# number of values other processes wrote with SetValue and SetItems, by completion-code
+		self.writes = [0, 0, 0]
+
 		# dict containing the onchange callbacks, for each object. Object path is the key
 		self._onchangecallbacks = {}
 
@@ -76,7 +107,9 @@ class VeDbusService(object):
 		self.dbusconn = self._dbusconn
 
 		# Add the root item that will return all items as a tree
-		self._dbusnodes['/'] = VeDbusRootExport(self._dbusconn, '/', self)
+		self._fallback = fallback
+		rootexport = VeDbusFallbackRootExport if fallback else VeDbusRootExport
+		self._dbusnodes['/'] = rootexport(self._dbusconn, '/', self)
 
 		# Immediately register the service unless requested not to
 		if register:
@@ -116,19 +149,30 @@ class VeDbusService(object):
 		if onchangecallback is not None:
 			self._onchangecallbacks[path] = onchangecallback
 
-		itemtype = itemtype or VeDbusItemExport
+		itemtype = itemtype or (VeDbusItemFallback if self._fallback else VeDbusItemExport)
 		item = itemtype(self._dbusconn, path, value, description, writeable,
-				self._value_changed, gettextcallback, deletecallback=self._item_deleted, valuetype=valuetype)
+				self._value_changed, gettextcallback, deletecallback=self._item_deleted, valuetype=valuetype,
+				publishcallback=self._item_changed, invalidatecallback=self._dbusnodes['/'].invalidate,
+				signaltext=self._signaltext, writtencallback=self._item_written, resultcallback=self._count_write)
 
-		spl = path.split('/')
+		spl = path.split('/') if not self._fallback else ()
 		for i in range(2, len(spl)):
 			subPath = '/'.join(spl[:i])
 			if subPath not in self._dbusnodes and subPath not in self._dbusobjects:
 				self._dbusnodes[subPath] = VeDbusTreeExport(self._dbusconn, subPath, self)
+		if path not in self._dbusobjects:
+			insort(self._sortedpaths, path)
 		self._dbusobjects[path] = item
+		self._dbusnodes['/'].invalidate(path)
 		logging.debug('added %s with start value %s. Writeable is %s' % (path, value, writeable))
 		return item
 
+	# Enables or disables the text in the change signals of all items, see signaltext
+	def set_signal_text(self, signaltext):
+		self._signaltext = signaltext
+		for item in self._dbusobjects.values():
+			item._signaltext = signaltext
+
 	# Add the mandatory paths, as per victron dbus api doc
 	def add_mandatory_paths(self, processname, processversion, connection,
 			deviceinstance, productid, productname, firmwareversion, hardwareversion, connected):
@@ -152,17 +196,57 @@ class VeDbusService(object):
 
 		return self._onchangecallbacks[path](path, newvalue)
 
+	# Callback function that is called from the VeDbusItemExport objects when their value has changed. When a
+	# publisher is set the change is staged there, so that it ends up in one ItemsChanged signal together with
+	# the other changes. Otherwise the item emits its own PropertiesChanged signal, as it always did.
+	def _item_changed(self, path, changes):
+		if self.publisher is not None:
+			self.publisher.stage(path, changes)
+		else:
+			self._dbusnodes['/'].item_changed(path, changes)
+
+	# Callback function that is called from the VeDbusItemExport objects when another process wrote a value
+	def _item_written(self, path, newvalue, sender=None):
+		if self.writecallback is None:
+			return True
+		return self.writecallback(path, newvalue, sender)
+
+	# Callback function that is called from the VeDbusItemExport objects with the completion-code of every SetValue
+	def _count_write(self, code):
+		self.writes[code] += 1
+
+	# Emits a batch of changes as one ItemsChanged signal, or hands them to the publisher when one is set.
+	def _items_changed(self, changes):
+		if self.publisher is not None:
+			for path, c in changes.items():
+				self.publisher.stage(path, c)
+		else:
+			self._dbusnodes['/'].ItemsChanged(changes)
+
 	def _item_deleted(self, path):
 		self._dbusobjects.pop(path)
+		if '/' in self._dbusnodes:
+			self._dbusnodes['/'].invalidate(path)
+		i = bisect_left(self._sortedpaths, path)
+		if i < len(self._sortedpaths) and self._sortedpaths[i] == path:
+			del self._sortedpaths[i]
 		for np in list(self._dbusnodes.keys()):
 			if np != '/':
-				for ip in self._dbusobjects:
-					if ip.startswith(np + '/'):
-						break
+				for ip in self._subtree(np + '/'):
+					break
 				else:
 					self._dbusnodes[np].__del__()
 					self._dbusnodes.pop(np)
 
+	# Returns the paths that start with prefix, in sorted order. Costs a binary search plus
+	# the number of paths found, instead of going through all paths.
+	def _subtree(self, prefix):
+		paths = self._sortedpaths
+		i = bisect_left(paths, prefix)
+		while i < len(paths) and paths[i].startswith(prefix):
+			yield paths[i]
+			i += 1
+
 	def __getitem__(self, path):
 		return self._dbusobjects[path].local_get_value()
 
@@ -208,9 +292,12 @@ class ServiceContext(object):
 			del self.changes[path]
 		del self.parent[path]
 
+	def stage(self, path, changes):
+		self.changes[path] = changes
+
 	def flush(self):
 		if self.changes:
-			self.parent._dbusnodes['/'].ItemsChanged(self.changes)
+			self.parent._items_changed(self.changes)
 			self.changes.clear()
 
 	def add_path(self, path, value, *args, **kwargs):
@@ -222,10 +309,12 @@ class ServiceContext(object):
 
 	def del_tree(self, root):
 		root = root.rstrip('/')
-		for p in list(self.parent._dbusobjects.keys()):
-			if p == root or p.startswith(root + '/'):
-				self[p] = None
-				self.parent._dbusobjects[p].__del__()
+		paths = list(self.parent._subtree(root + '/'))
+		if root in self.parent._dbusobjects:
+			paths.append(root)
+		for p in paths:
+			self[p] = None
+			self.parent._dbusobjects[p].__del__()
 
 	def get_name(self):
 		return self.parent.get_name()
@@ -430,7 +519,7 @@ class VeDbusItemImport(object):
 
 class VeDbusTreeExport(dbus.service.Object):
 	def __init__(self, bus, objectPath, service):
-		dbus.service.Object.__init__(self, bus, objectPath)
+		self._register(bus, objectPath)
 		self._service = service
 		logging.debug("VeDbusTreeExport %s has been created" % objectPath)
 
@@ -443,6 +532,9 @@ class VeDbusTreeExport(dbus.service.Object):
 		self.remove_from_connection()
 		logging.debug("VeDbusTreeExport %s has been removed" % path)
 
+	def _register(self, bus, objectPath):
+		dbus.service.Object.__init__(self, bus, objectPath)
+
 	def _get_path(self):
 		if len(self._locations) == 0:
 			return None
@@ -454,10 +546,11 @@ class VeDbusTreeExport(dbus.service.Object):
 		px = path
 		if not px.endswith('/'):
 			px += '/'
-		for p, item in self._service._dbusobjects.items():
-			if p.startswith(px):
-				v = item.GetText() if get_text else wrap_dbus_value(item.local_get_value())
-				r[p[len(px):]] = v
+		dbusobjects = self._service._dbusobjects
+		for p in self._service._subtree(px):
+			item = dbusobjects[p]
+			v = item.GetText() if get_text else wrap_dbus_value(item.local_get_value())
+			r[p[len(px):]] = v
 		logging.debug(r)
 		return r
 
@@ -474,18 +567,76 @@ class VeDbusTreeExport(dbus.service.Object):
 		return self._get_value_handler(self.path)
 
 class VeDbusRootExport(VeDbusTreeExport):
+	def __init__(self, bus, objectPath, service):
+		VeDbusTreeExport.__init__(self, bus, objectPath, service)
+		# Cached result of GetItems. Only the entries of paths that were changed, added or
+		# removed since the last call are built again. cache_hits counts the calls that were
+		# answered without building anything, cache_rebuilds the entries that were built.
+		self._items = {}
+		self._stale = set()
+		self.cache_hits = 0
+		self.cache_rebuilds = 0
+		# number of PropertiesChanged and ItemsChanged signals emitted
+		self.signals = 0
+
+	## Marks the cached GetItems entry of a path as outdated.
+	def invalidate(self, path):
+		self._stale.add(path)
+
+	## Emits the PropertiesChanged signal of an item.
+	def item_changed(self, path, changes):
+		self.signals += 1
+		self._service._dbusobjects[path].PropertiesChanged(changes)
+
 	@dbus.service.signal('com.victronenergy.BusItem', signature='a{sa{sv}}')
 	def ItemsChanged(self, changes):
-		pass
+		self.signals += 1
 
 	@dbus.service.method('com.victronenergy.BusItem', out_signature='a{sa{sv}}')
 	def GetItems(self):
-		return {
-			path: {
-				'Value': wrap_dbus_value(item.local_get_value()),
-				'Text': item.GetText() }
-			for path, item in self._service._dbusobjects.items()
-		}
+		if not self._stale:
+			self.cache_hits += 1
+			return self._items
+
+		dbusobjects = self._service._dbusobjects
+		for path in self._stale:
+			item = dbusobjects.get(path)
+			if item is None:
+				self._items.pop(path, None)
+			else:
+				self._items[path] = {
+					'Value': wrap_dbus_value(item.local_get_value()),
+					'Text': item.GetText() }
+		self.cache_rebuilds += len(self._stale)
+		self._stale.clear()
+		return self._items
+
+	## Dbus exported method SetItems
+	# Sets several values in one call. Every value is checked the same way as SetValue does,
+	# including the onchangecallback. All accepted values are applied together and result in
+	# one single ItemsChanged signal.
+	# @param items dict with the path as key and the new value as value.
+	# @return dict with the completion-code of SetValue for each path, 1 for unknown paths.
+	@dbus.service.method('com.victronenergy.BusItem', in_signature='a{sv}', out_signature='a{si}',
+			sender_keyword='sender')
+	def SetItems(self, items, sender=None):
+		result = {}
+		with self._service as ctx:
+			for path, value in items.items():
+				item = self._service._dbusobjects.get(path)
+				if item is None and self._service.missingpathcallback is not None and \
+						self._service.missingpathcallback(path):
+					item = self._service._dbusobjects.get(path)
+				if item is None:
+					result[path] = 1  # NOT OK
+					self._service._count_write(1)
+					continue
+				code, value = item._check_set_value(value)
+				if code == 0 and self._service._item_written(path, value, sender):
+					ctx[path] = value
+				result[path] = code
+				self._service._count_write(code)
+		return dbus.Dictionary(result, signature='si')
 
 
 class VeDbusItemExport(dbus.service.Object):
@@ -501,13 +652,30 @@ class VeDbusItemExport(dbus.service.Object):
 	# @param callback	  Function that will be called when someone else changes the value of this VeBusItem
 	#                     over the dbus. First parameter passed to callback will be our path, second the new
 	#					  value. This callback should return True to accept the change, False to reject it.
+	# @param publishcallback  Function that will be called with our path and the changes instead of emitting
+	#					  PropertiesChanged ourselves. Used by VeDbusService to batch changes.
+	# @param invalidatecallback  Function that will be called with our path whenever the value changed, used
+	#					  by VeDbusService to keep the GetItems cache up to date.
+	# @param signaltext   Whether PropertiesChanged contains the text. When False, the text is only rendered
+	#					  when it is read. Either way it is rendered at most once per value.
+	# @param writtencallback  Function that will be called with our path, the new value and the sender after
+	#					  every accepted SetValue, also when the value did not change. The value is only
+	#					  applied when it returns True.
+	# @param resultcallback  Function that will be called with the completion-code of every SetValue.
 	def __init__(self, bus, objectPath, value=None, description=None, writeable=False,
 					onchangecallback=None, gettextcallback=None, deletecallback=None,
-					valuetype=None):
-		dbus.service.Object.__init__(self, bus, objectPath)
+					valuetype=None, publishcallback=None, invalidatecallback=None, signaltext=True,
+					writtencallback=None, resultcallback=None):
+		self._register(bus, objectPath)
 		self._onchangecallback = onchangecallback
 		self._gettextcallback = gettextcallback
+		self._publishcallback = publishcallback
+		self._invalidatecallback = invalidatecallback
+		self._signaltext = signaltext
+		self._writtencallback = writtencallback
+		self._resultcallback = resultcallback
 		self._value = value
+		self._text = None  # text of _value, rendered on first use
 		self._description = description
 		self._writeable = writeable
 		self._deletecallback = deletecallback
@@ -520,11 +688,16 @@ class VeDbusItemExport(dbus.service.Object):
 		path = self._get_path()
 		if path == None:
 			return
+		# invalidate first, so that the consumers of the change signals do not keep the last value
+		self.local_set_value(None)
 		if self._deletecallback is not None:
 			self._deletecallback(path)
 		self.remove_from_connection()
 		logging.debug("VeDbusItemExport %s has been removed" % path)
 
+	def _register(self, bus, objectPath):
+		dbus.service.Object.__init__(self, bus, objectPath)
+
 	def _get_path(self):
 		if len(self._locations) == 0:
 			return None
@@ -536,7 +709,11 @@ class VeDbusItemExport(dbus.service.Object):
 	# set value to None to indicate that it is Invalid
 	def local_set_value(self, newvalue):
 		changes = self._local_set_value(newvalue)
-		if changes is not None:
+		if changes is None:
+			return
+		if self._publishcallback is not None:
+			self._publishcallback(self.__dbus_object_path__, changes)
+		else:
 			self.PropertiesChanged(changes)
 
 	def _local_set_value(self, newvalue):
@@ -544,6 +721,11 @@ class VeDbusItemExport(dbus.service.Object):
 			return None
 
 		self._value = newvalue
+		self._text = None
+		if self._invalidatecallback is not None:
+			self._invalidatecallback(self.__dbus_object_path__)
+		if not self._signaltext:
+			return {'Value': wrap_dbus_value(newvalue)}
 		return {
 			'Value': wrap_dbus_value(newvalue),
 			'Text': self.GetText()
@@ -558,11 +740,26 @@ class VeDbusItemExport(dbus.service.Object):
 	# Function is called over the D-Bus by other process. It will first check (via callback) if new
 	# value is accepted. And it is, stores it and emits a changed-signal.
 	# @param value The new value.
+	# @param sender The unique bus name of the caller, filled in by dbus-python.
 	# @return completion-code When successful a 0 is return, and when not a -1 is returned.
-	@dbus.service.method('com.victronenergy.BusItem', in_signature='v', out_signature='i')
-	def SetValue(self, newvalue):
+	@dbus.service.method('com.victronenergy.BusItem', in_signature='v', out_signature='i',
+			sender_keyword='sender')
+	def SetValue(self, newvalue, sender=None):
+		code, newvalue = self._check_set_value(newvalue)
+		if self._resultcallback is not None:
+			self._resultcallback(code)
+		if code == 0 and (self._writtencallback is None or
+				self._writtencallback(self.__dbus_object_path__, newvalue, sender)):
+			self.local_set_value(newvalue)
+		return code
+
+	## Checks a value that is written by another process over the D-Bus, see SetValue and
+	# VeDbusRootExport.SetItems. Runs the onchangecallback when the value is different.
+	# @param value The new value, as received over the D-Bus.
+	# @return tuple with the completion-code and the unwrapped (and casted) value.
+	def _check_set_value(self, newvalue):
 		if not self._writeable:
-			return 1  # NOT OK
+			return 1, None  # NOT OK
 
 		newvalue = unwrap_dbus_value(newvalue)
 
@@ -574,19 +771,17 @@ class VeDbusItemExport(dbus.service.Object):
 			try:
 				newvalue = self._type(newvalue)
 			except (ValueError, TypeError):
-				return 1 # NOT OK
+				return 1, None # NOT OK
 
 		if newvalue == self._value:
-			return 0  # OK
+			return 0, newvalue  # OK
 
 		# call the callback given to us, and check if new value is OK.
 		if (self._onchangecallback is None or
 				(self._onchangecallback is not None and self._onchangecallback(self.__dbus_object_path__, newvalue))):
+			return 0, newvalue  # OK
 
-			self.local_set_value(newvalue)
-			return 0  # OK
-
-		return 2  # NOT OK
+		return 2, None  # NOT OK
 
 	## Dbus exported method GetDescription
 	#
@@ -610,6 +805,11 @@ class VeDbusItemExport(dbus.service.Object):
 	# @return text A text-value. '---' when local value is invalid
 	@dbus.service.method('com.victronenergy.BusItem', out_signature='s')
 	def GetText(self):
+		if self._text is None:
+			self._text = self._get_text()
+		return self._text
+
+	def _get_text(self):
 		if self._value is None:
 			return '---'
 
@@ -634,6 +834,108 @@ class VeDbusItemExport(dbus.service.Object):
 	def PropertiesChanged(self, changes):
 		pass
 
+BUSITEM_INTERFACE = 'com.victronenergy.BusItem'
+
+def _unknown_object(path):
+	return dbus.exceptions.DBusException("No object at path %s" % path,
+		name='org.freedesktop.DBus.Error.UnknownObject')
+
+## Root object that answers the BusItem calls of all paths of the service, used when VeDbusService
+# is created with fallback=True. The paths are looked up in the flat table of the service, so there
+# is no dbus object per path and no VeDbusTreeExport per node. GetValue and GetText of a node return
+# the same dict as VeDbusTreeExport does.
+class VeDbusFallbackRootExport(VeDbusRootExport, dbus.service.FallbackObject):
+	def _register(self, bus, objectPath):
+		dbus.service.FallbackObject.__init__(self, bus, objectPath)
+
+	def _node(self, path):
+		for p in self._service._subtree(path.rstrip('/') + '/'):
+			return path
+		raise _unknown_object(path)
+
+	def item_changed(self, path, changes):
+		self.signals += 1
+		message = SignalMessage(path, BUSITEM_INTERFACE, 'PropertiesChanged')
+		message.append(changes, signature='a{sv}')
+		self.connection.send_message(message)
+
+	@dbus.service.method(BUSITEM_INTERFACE, out_signature='v', path_keyword='path')
+	def GetValue(self, path='/'):
+		item = self._service._dbusobjects.get(path)
+		if item is not None:
+			return item.GetValue()
+		value = self._get_value_handler(self._node(path))
+		return dbus.Dictionary(value, signature=dbus.Signature('sv'), variant_level=1)
+
+	# The out_signature is guessed: a string for items and a variant with a dict for nodes, which is
+	# what VeDbusItemExport and VeDbusTreeExport return.
+	@dbus.service.method(BUSITEM_INTERFACE, path_keyword='path')
+	def GetText(self, path='/'):
+		item = self._service._dbusobjects.get(path)
+		if item is not None:
+			return dbus.String(item.GetText())
+		value = self._get_value_handler(self._node(path), True)
+		return dbus.Dictionary(value, signature=dbus.Signature('ss'), variant_level=1)
+
+	@dbus.service.method(BUSITEM_INTERFACE, in_signature='v', out_signature='i', path_keyword='path',
+			sender_keyword='sender')
+	def SetValue(self, newvalue, path='/', sender=None):
+		item = self._service._dbusobjects.get(path)
+		# a path that is not registered yet may be added on the first write, as SetItems does
+		if item is None and self._service.missingpathcallback is not None and \
+				self._service.missingpathcallback(path):
+			item = self._service._dbusobjects.get(path)
+		if item is None:
+			self._service._count_write(1)
+			raise _unknown_object(path)
+		return item.SetValue(newvalue, sender)
+
+	@dbus.service.method(BUSITEM_INTERFACE, in_signature='si', out_signature='s', path_keyword='path')
+	def GetDescription(self, language, length, path='/'):
+		item = self._service._dbusobjects.get(path)
+		if item is None:
+			raise _unknown_object(path)
+		return item.GetDescription(language, length)
+
+	# Adds the paths below object_path as child nodes, so that tools that walk the tree with
+	# introspection still find all paths.
+	@dbus.service.method(dbus.INTROSPECTABLE_IFACE, in_signature='', out_signature='s',
+			path_keyword='object_path', connection_keyword='connection')
+	def Introspect(self, object_path, connection):
+		xml = dbus.service.Object.Introspect(self, object_path, connection)
+		prefix = object_path.rstrip('/') + '/'
+		children = []
+		for p in self._service._subtree(prefix):
+			name = p[len(prefix):].split('/', 1)[0]
+			if name not in children:
+				children.append(name)
+		end = xml.rindex('</node>')
+		nodes = ''.join('  <node name="%s"/>\n' % name for name in children)
+		return xml[:end] + nodes + xml[end:]
+
+## Same as VeDbusItemExport, but not registered on the dbus by itself. The VeDbusFallbackRootExport
+# answers the calls for its path, which saves a dbus object and its registration per path.
+class VeDbusItemFallback(VeDbusItemExport):
+	def _register(self, bus, objectPath):
+		self._path = objectPath
+
+	@property
+	def __dbus_object_path__(self):
+		return self._path
+
+	def _get_path(self):
+		return self._path
+
+	def __del__(self):
+		path = self._path
+		if path is None:
+			return
+		self.local_set_value(None)
+		self._path = None
+		if self._deletecallback is not None:
+			self._deletecallback(path)
+		logging.debug("VeDbusItemFallback %s has been removed" % path)
+
 ## This class behaves like a regular reference to a class method (eg. self.foo), but keeps a weak reference
 ## to the object which method is to be called.
 ## Use this object to break circular references.
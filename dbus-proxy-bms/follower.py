@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+import logging
+import sys
+import os
+from fnmatch import fnmatchcase
+
+# import Victron Energy packages
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), "ext", "velib_python"))
+from vedbus import VeDbusRootTracker, weak_functor
+from ve_utils import unwrap_dbus_value, add_name_owner_changed_receiver
+
+
+class UpstreamTracker(VeDbusRootTracker):
+    """
+    Tracks all values of one upstream service.
+
+    The initial values are fetched with a single asynchronous GetItems call, afterwards the
+    ItemsChanged signal (handled by VeDbusRootTracker) and the PropertiesChanged signal of
+    services that still publish every path on its own keep them up to date.
+    """
+
+    def __init__(self, bus, servicename, callback):
+        self._bus = bus
+        self._callback = callback
+        VeDbusRootTracker.__init__(self, bus, servicename)
+
+        self._properties_match = bus.add_signal_receiver(
+            weak_functor(self._properties_changed_handler),
+            signal_name="PropertiesChanged",
+            dbus_interface="com.victronenergy.BusItem",
+            bus_name=servicename,
+            path_keyword="path",
+        )
+
+        self.refresh()
+
+    def __del__(self):
+        if self._properties_match is not None:
+            self._properties_match.remove()
+            self._properties_match = None
+        VeDbusRootTracker.__del__(self)
+
+    def _items_changed_handler(self, items):
+        if not isinstance(items, dict):
+            return
+
+        changes = {}
+        for path, item in items.items():
+            try:
+                changes[str(path)] = unwrap_dbus_value(item["Value"])
+            except KeyError:
+                continue
+
+        if changes:
+            self._callback(self.serviceName, changes)
+
+    def _properties_changed_handler(self, changes, path=None):
+        if path is None or "Value" not in changes:
+            return
+        self._callback(self.serviceName, {str(path): unwrap_dbus_value(changes["Value"])})
+
+    def refresh(self):
+        """
+        Fetches all values of the service again.
+        """
+        self._bus.get_object(self.serviceName, "/", introspect=False).GetItems(
+            reply_handler=weak_functor(self._items_changed_handler),
+            error_handler=weak_functor(self._get_items_failed),
+        )
+
+    def _get_items_failed(self, error):
+        logging.warning("could not get the values of %s: %s" % (self.serviceName, error))
+
+
+class BatteryFollower:
+    """
+    Mirrors the values of one or more upstream battery services.
+
+    The services to follow are given as a list of names, which may contain wildcards, e.g.
+    `com.victronenergy.battery.ttyUSB*`. Services that appear later on the bus are picked up
+    automatically.
+
+    Every change is translated with `mapping` (upstream path -> own path) and passed to
+    `update_callback(servicename, {path: value})` in one batch. When a service leaves the bus
+    `remove_callback(servicename)` is called.
+    """
+
+    def __init__(self, bus, services, mapping, update_callback, remove_callback, ownname=None):
+        self._bus = bus
+        self._patterns = services
+        self._mapping = mapping
+        self._update_callback = update_callback
+        self._remove_callback = remove_callback
+        self._ownname = ownname
+        self._trackers = {}
+
+        add_name_owner_changed_receiver(bus, self._name_owner_changed)
+
+        for name in bus.list_names():
+            self._name_owner_changed(str(name), "", "x")
+
+    def set_mapping(self, mapping):
+        """
+        Replaces the mapping and fetches all values of the followed services again, so that newly mapped
+        paths get their values right away.
+        """
+        self._mapping = mapping
+        for tracker in self._trackers.values():
+            tracker.refresh()
+
+    @property
+    def services(self):
+        return list(self._trackers.keys())
+
+    def _is_followed(self, name):
+        if name == self._ownname:
+            return False
+        for pattern in self._patterns:
+            if fnmatchcase(name, pattern):
+                return True
+        return False
+
+    def _name_owner_changed(self, name, oldowner, newowner):
+        if not self._is_followed(name):
+            return
+
+        if oldowner and name in self._trackers:
+            logging.info("upstream service %s left the bus" % name)
+            self._trackers.pop(name).__del__()
+            self._remove_callback(name)
+
+        if newowner:
+            logging.info("following upstream service %s" % name)
+            self._trackers[name] = UpstreamTracker(self._bus, name, self._upstream_changed)
+
+    def _upstream_changed(self, servicename, changes):
+        mapped = {}
+        for path, value in changes.items():
+            target = self._mapping.get(path)
+            if target is not None:
+                mapped[target] = value
+
+        if mapped:
+            logging.debug("%s changed %s" % (servicename, mapped))
+            self._update_callback(servicename, mapped)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+from gi.repository import GLib
+import logging
+from time import monotonic
+
+
+class TimerWheel:
+    """
+    Schedules keys to expire a number of ticks in the future. Scheduling, rescheduling and cancelling a
+    key is O(1), advancing the wheel by one tick costs the number of keys that expire in that tick.
+    The number of slots has to be larger than the largest number of ticks a key is scheduled for.
+    """
+
+    def __init__(self, slots):
+        self._slots = [set() for _ in range(slots)]
+        self._slot_of = {}
+        self.tick = 0
+
+    def schedule(self, key, ticks):
+        self.cancel(key)
+        slot = (self.tick + ticks) % len(self._slots)
+        self._slots[slot].add(key)
+        self._slot_of[key] = slot
+
+    def cancel(self, key):
+        slot = self._slot_of.pop(key, None)
+        if slot is not None:
+            self._slots[slot].discard(key)
+
+    def keys(self):
+        return list(self._slot_of)
+
+    def advance(self):
+        """
+        Moves the wheel one tick forward and returns the keys that expired.
+        """
+        self.tick += 1
+        slot = self.tick % len(self._slots)
+        expired = self._slots[slot]
+        if expired:
+            self._slots[slot] = set()
+            for key in expired:
+                del self._slot_of[key]
+        return expired
+
+
+class FreshnessTracker:
+    """
+    Tracks when each path was written for the last time and reports the paths that were not written
+    again within their timeout. All paths share one timer wheel that is driven by one GLib timer.
+
+    @param timeout   default timeout in seconds, 0 = paths are not tracked
+    @param timeouts  dict with a path or path prefix as key and the timeout in seconds as value, the
+                     longest matching prefix wins
+    @param callback  function that is called with the set of expired paths
+    @param tick      resolution of the timeouts in seconds
+    """
+
+    def __init__(self, timeout, timeouts, callback, tick=1.0):
+        self._timeout = timeout
+        self._timeouts = sorted(timeouts.items(), key=lambda t: len(t[0]), reverse=True)
+        self._callback = callback
+        self._tick = tick
+        self._ticks = {}
+
+        longest = max([timeout] + list(timeouts.values()))
+        # one tick more than the timeout, so that a path is never invalidated too early
+        self._wheel = TimerWheel(int(longest / tick) + 2)
+        self._start = monotonic()
+        self._timer = GLib.timeout_add(int(tick * 1000), self._on_tick)
+
+    def _ticks_for(self, path):
+        ticks = self._ticks.get(path)
+        if ticks is None:
+            timeout = self._timeout
+            for prefix, t in self._timeouts:
+                if path == prefix or path.startswith(prefix.rstrip("/") + "/"):
+                    timeout = t
+                    break
+            ticks = int(timeout / self._tick) + 1 if timeout > 0 else 0
+            self._ticks[path] = ticks
+        return ticks
+
+    def touch(self, path):
+        ticks = self._ticks_for(path)
+        if ticks:
+            self._wheel.schedule(path, ticks)
+
+    def forget(self, path):
+        self._wheel.cancel(path)
+
+    def stop(self):
+        """
+        Stops the timer and returns the paths that were tracked.
+        """
+        GLib.source_remove(self._timer)
+        return self._wheel.keys()
+
+    def _on_tick(self):
+        # the timer can fire late when the main loop is busy, catch up with all ticks that passed
+        due = int((monotonic() - self._start) / self._tick)
+        expired = set()
+        while self._wheel.tick < due:
+            expired |= self._wheel.advance()
+
+        if expired:
+            logging.debug("paths expired: %s" % sorted(expired))
+            self._callback(expired)
+        return True
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+from array import array
+import dbus
+import dbus.service
+import logging
+from time import monotonic, time
+
+
+class RingBuffer:
+    """
+    The last `size` samples of one path. The timestamps and the values are stored in two arrays that are
+    allocated once, so the memory use does not grow and every sample costs 8 bytes for the timestamp plus
+    4 (typecode "f") or 8 (typecode "d") bytes for the value.
+    """
+
+    def __init__(self, size, typecode="f"):
+        self.size = size
+        self._times = array("d", bytes(8 * size))
+        self._values = array(typecode, bytes(array(typecode).itemsize * size))
+        self._next = 0
+        self.count = 0
+
+    @property
+    def nbytes(self):
+        return self._times.itemsize * self.size + self._values.itemsize * self.size
+
+    def append(self, t, value):
+        self._times[self._next] = t
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def _index(self, i):
+        # array index of the i-th oldest sample
+        return (self._next - self.count + i) % self.size
+
+    def _first_at(self, t):
+        # number of samples older than t, the samples are in chronological order
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._times[self._index(mid)] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def downsample(self, start, end, buckets):
+        """
+        Returns a list with (start of the bucket, min, max, average) of the samples between start and end,
+        split into `buckets` buckets of the same length. Buckets without samples are left out.
+        """
+        if buckets <= 0 or end <= start:
+            return []
+
+        width = (end - start) / buckets
+        result = []
+        current = None
+        for i in range(self._first_at(start), self.count):
+            j = self._index(i)
+            t = self._times[j]
+            if t >= end:
+                break
+            value = self._values[j]
+            bucket = min(buckets - 1, int((t - start) / width))
+            if current is None or current[0] != bucket:
+                if current is not None:
+                    result.append((start + current[0] * width, current[1], current[2], current[3] / current[4]))
+                current = [bucket, value, value, value, 1]
+            else:
+                if value < current[1]:
+                    current[1] = value
+                if value > current[2]:
+                    current[2] = value
+                current[3] += value
+                current[4] += 1
+        if current is not None:
+            result.append((start + current[0] * width, current[1], current[2], current[3] / current[4]))
+        return result
+
+
+class History:
+    """
+    Short term history of selected paths, one RingBuffer per path. Only numeric values are recorded,
+    invalid values leave a gap.
+
+    The samples are stamped with the monotonic clock, so that they stay in order when the clock of the
+    system is set, and converted from and to unix time when they are queried.
+    """
+
+    def __init__(self, paths, size, typecode="f"):
+        self._buffers = {path: RingBuffer(size, typecode) for path in paths}
+        logging.info(
+            "history of %d paths with %d samples each uses %d bytes"
+            % (len(self._buffers), size, sum(b.nbytes for b in self._buffers.values()))
+        )
+
+    @property
+    def paths(self):
+        return self._buffers.keys()
+
+    def record(self, path, value):
+        buffer = self._buffers.get(path)
+        if buffer is not None and isinstance(value, (int, float)) and not isinstance(value, bool):
+            buffer.append(monotonic(), value)
+
+    def query(self, path, start, end, buckets):
+        """
+        See RingBuffer.downsample. A start of 0 or less is relative to now, e.g. -3600 for the last hour,
+        an end of 0 means now.
+        """
+        buffer = self._buffers.get(path)
+        if buffer is None:
+            raise KeyError(path)
+        now = monotonic()
+        offset = time() - now
+        start = now + start if start <= 0 else start - offset
+        end = now if end <= 0 else end - offset
+        return [(t + offset, lo, hi, average) for t, lo, hi, average in buffer.downsample(start, end, buckets)]
+
+
+class HistoryExport(dbus.service.Object):
+    """
+    Answers the history queries on the object /Proxy/History.
+    """
+
+    def __init__(self, bus, history, objectPath="/Proxy/History"):
+        dbus.service.Object.__init__(self, bus, objectPath)
+        self._history = history
+
+    @dbus.service.method("com.victronenergy.BusItem", out_signature="as")
+    def GetPaths(self):
+        return sorted(self._history.paths)
+
+    ## Returns (start of the bucket, min, max, average) for each bucket with samples
+    # @param path     the path, see GetPaths
+    # @param start    unix time, 0 or less is relative to now, e.g. -3600 for the last hour
+    # @param end      unix time, 0 = now
+    # @param buckets  number of buckets the time range is split into
+    @dbus.service.method("com.victronenergy.BusItem", in_signature="sddu", out_signature="a(dddd)")
+    def GetHistory(self, path, start, end, buckets):
+        try:
+            return self._history.query(path, start, end, buckets)
+        except KeyError:
+            raise dbus.exceptions.DBusException(
+                "No history of %s" % path, name="org.freedesktop.DBus.Error.InvalidArgs"
+            )
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+
+from gi.repository import GLib
+import errno
+import logging
+import socket
+import struct
+from time import monotonic
+
+# transaction ID, protocol ID, length, unit ID, function code, first register, number of registers
+REQUEST = struct.Struct(">HHHBBHH")
+# transaction ID, protocol ID, length, unit ID
+MBAP = struct.Struct(">HHHB")
+
+FUNCTIONS = {"holding": 3, "input": 4}
+TYPES = {"int16": "h", "uint16": "H", "int32": "i", "uint32": "I", "float32": "f"}
+
+
+class RegisterBlock:
+    """
+    A contiguous range of registers that is read with one request every `interval` ms. The registers are
+    decoded with one struct that is compiled from the fields, the registers between them are skipped.
+
+    @param fields  list of (path, register offset in the block, type, scale)
+    """
+
+    def __init__(self, name, function, start, count, interval, fields):
+        self.name = name
+        self.function = FUNCTIONS[function]
+        self.start = start
+        self.count = count
+        self.interval = interval
+        self.pending = None
+
+        layout = ">"
+        position = 0
+        self._fields = []
+        for path, offset, kind, scale in sorted(fields, key=lambda f: f[1]):
+            if offset * 2 < position:
+                raise ValueError("%s overlaps the previous field in block %s" % (path, name))
+            if offset * 2 > position:
+                layout += "%dx" % (offset * 2 - position)
+            layout += TYPES[kind]
+            position = offset * 2 + struct.calcsize(">" + TYPES[kind])
+            self._fields.append((path, scale))
+        if position > count * 2:
+            raise ValueError("the fields of block %s do not fit into %d registers" % (name, count))
+        self._layout = struct.Struct(layout)
+
+    def decode(self, data, changes):
+        for (path, scale), value in zip(self._fields, self._layout.unpack_from(data)):
+            changes[path] = value * scale if scale != 1 else value
+
+
+class ModbusInput:
+    """
+    Polls register blocks of a Modbus-TCP device and passes the decoded values to `callback` as one dict
+    of path -> value.
+
+    All blocks share one persistent connection. The requests of the blocks that are due are sent without
+    waiting for the previous responses, each with its own transaction ID, and the responses are matched
+    by it. The socket is non-blocking and watched by the main loop, so a slow device never blocks it.
+    """
+
+    def __init__(self, host, port, unit, blocks, callback, timeout=2000):
+        self.host = host
+        self.port = port
+        self.unit = unit
+        self.blocks = blocks
+        self.timeout = timeout / 1000
+        self._callback = callback
+        self._socket = None
+        self._watch = None
+        self._connected = False
+        self._buffer = b""
+        self._transaction = 0
+        self._pending = {}
+        self._connect_started = 0
+
+        for block in blocks:
+            GLib.timeout_add(block.interval, self._poll, block)
+        self._connect()
+
+    def _connect(self):
+        logging.info("connecting to Modbus-TCP device %s:%d" % (self.host, self.port))
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setblocking(False)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._connect_started = monotonic()
+        try:
+            self._socket.connect((self.host, self.port))
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self._failed("could not connect: %s" % e)
+            return
+        self._watch = GLib.io_add_watch(
+            self._socket.fileno(),
+            GLib.PRIORITY_DEFAULT,
+            GLib.IO_OUT | GLib.IO_ERR | GLib.IO_HUP,
+            self._on_connected,
+        )
+
+    def _on_connected(self, fd, condition):
+        error = self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self._watch = None
+            self._failed("could not connect: %s" % errno.errorcode.get(error, error))
+            return False
+        logging.info("connected to Modbus-TCP device %s:%d" % (self.host, self.port))
+        self._connected = True
+        self._watch = GLib.io_add_watch(
+            self._socket.fileno(),
+            GLib.PRIORITY_DEFAULT,
+            GLib.IO_IN | GLib.IO_ERR | GLib.IO_HUP,
+            self._on_readable,
+        )
+        return False
+
+    def _failed(self, reason):
+        logging.warning("Modbus-TCP device %s:%d: %s, reconnecting" % (self.host, self.port, reason))
+        if self._watch is not None:
+            GLib.source_remove(self._watch)
+            self._watch = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        self._connected = False
+        self._buffer = b""
+        self._pending.clear()
+        for block in self.blocks:
+            block.pending = None
+        GLib.timeout_add(int(self.timeout * 1000), self._reconnect)
+
+    def _reconnect(self):
+        self._connect()
+        return False
+
+    def _poll(self, block):
+        if self._socket is None:
+            return True
+        now = monotonic()
+        if not self._connected:
+            if now - self._connect_started > self.timeout:
+                self._failed("timeout while connecting")
+            return True
+        if block.pending is not None:
+            if now - self._pending[block.pending][1] > self.timeout:
+                self._failed("no response to the request of block %s" % block.name)
+            return True
+
+        self._transaction = (self._transaction + 1) & 0xFFFF
+        request = REQUEST.pack(self._transaction, 0, 6, self.unit, block.function, block.start, block.count)
+        try:
+            self._socket.send(request)
+        except OSError as e:
+            self._failed("could not send: %s" % e)
+            return True
+        block.pending = self._transaction
+        self._pending[self._transaction] = (block, now)
+        return True
+
+    def _on_readable(self, fd, condition):
+        try:
+            data = self._socket.recv(65536)
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            self._watch = None
+            self._failed("could not receive: %s" % e)
+            return False
+        if not data:
+            self._watch = None
+            self._failed("connection closed")
+            return False
+
+        self._buffer += data
+        changes = {}
+        # the buffer can contain several responses and the start of the next one
+        while len(self._buffer) >= MBAP.size:
+            transaction, protocol, length, unit = MBAP.unpack_from(self._buffer)
+            end = MBAP.size - 1 + length
+            if len(self._buffer) < end:
+                break
+            pdu, self._buffer = self._buffer[MBAP.size : end], self._buffer[end:]
+            self._response(transaction, pdu, changes)
+
+        if changes:
+            self._callback(changes)
+        return True
+
+    def _response(self, transaction, pdu, changes):
+        pending = self._pending.pop(transaction, None)
+        if pending is None:
+            logging.debug("ignoring response with unknown transaction ID %d" % transaction)
+            return
+        block = pending[0]
+        block.pending = None
+
+        if not pdu:
+            return
+        if pdu[0] & 0x80:
+            logging.warning("Modbus exception %d for block %s" % (pdu[1] if len(pdu) > 1 else -1, block.name))
+            return
+        if len(pdu) < 2 or pdu[1] != block.count * 2 or len(pdu) < 2 + pdu[1]:
+            logging.warning("invalid response for block %s" % block.name)
+            return
+        block.decode(pdu[2:], changes)
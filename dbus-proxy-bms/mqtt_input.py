@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+from gi.repository import GLib
+import json
+import logging
+import threading
+
+
+def compile_mapping(mapping):
+    """
+    Compiles a mapping of JSON keys to D-Bus paths into a tree that has the same shape as the JSON documents.
+    A key like "Dc/Voltage" addresses {"Dc": {"Voltage": ...}}, a key ending with "/*" maps all keys below it,
+    e.g. "Voltages/* = /Voltages/*" maps {"Voltages": {"Cell1": ...}} to /Voltages/Cell1.
+    """
+    tree = {}
+    for key, path in mapping.items():
+        keys = key.strip("/").split("/")
+        wildcard = keys[-1] == "*"
+        if wildcard:
+            keys = keys[:-1]
+        node = tree
+        for k in keys[:-1]:
+            child = node.get(k)
+            if not isinstance(child, dict):
+                child = node[k] = {}
+            node = child
+        if wildcard:
+            # a tuple marks a node whose keys are all mapped below the path prefix
+            node[keys[-1]] = (path.rstrip("*").rstrip("/") + "/",)
+        else:
+            node[keys[-1]] = path
+    return tree
+
+
+def decode(tree, document, changes):
+    """
+    Walks the document along the compiled tree and adds the mapped values to `changes`. Keys that are not
+    mapped are skipped without looking into them.
+    """
+    for key, value in document.items():
+        node = tree.get(key)
+        if node is None:
+            continue
+        if isinstance(node, str):
+            changes[node] = value
+        elif isinstance(value, dict):
+            if isinstance(node, tuple):
+                for k, v in value.items():
+                    changes[node[0] + k] = v
+            else:
+                decode(node, value, changes)
+    return changes
+
+
+class MqttInput:
+    """
+    Subscribes to MQTT topics that carry one JSON document per battery snapshot and passes the values of
+    each document to `callback` as one dict of path -> value.
+
+    The connection runs on the network thread of paho-mqtt, which also decodes the documents, so the main
+    loop never waits for the broker. The decoded changes are handed over to the main loop, if several
+    documents arrive before it got to them, they are merged and applied together.
+    """
+
+    def __init__(self, broker, port, topics, mapping, callback, username=None, password=None, tls=False, client_id=None):
+        import paho.mqtt.client as mqtt
+
+        self.topics = topics
+        self._tree = compile_mapping(mapping)
+        self._callback = callback
+        self._lock = threading.Lock()
+        self._pending = {}
+
+        try:
+            self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id)
+        except AttributeError:
+            # paho-mqtt < 2.0
+            self._client = mqtt.Client(client_id)
+        if username:
+            self._client.username_pw_set(username, password)
+        if tls:
+            self._client.tls_set()
+        self._client.on_connect = self._on_connect
+        self._client.on_disconnect = self._on_disconnect
+        self._client.on_message = self._on_message
+        self._client.reconnect_delay_set(min_delay=1, max_delay=60)
+
+        logging.info("connecting to MQTT broker %s:%d" % (broker, port))
+        self._client.connect_async(broker, port)
+        self._client.loop_start()
+
+    def set_mapping(self, mapping):
+        """
+        Replaces the mapping, the documents that arrive afterwards are decoded with the new one.
+        """
+        self._tree = compile_mapping(mapping)
+
+    # ==== called on the network thread of paho-mqtt ====
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logging.error("MQTT broker refused the connection, return code %s" % rc)
+            return
+        logging.info("connected to MQTT broker, subscribing to %s" % ", ".join(self.topics))
+        client.subscribe([(topic, 0) for topic in self.topics])
+
+    def _on_disconnect(self, client, userdata, rc):
+        if rc != 0:
+            logging.warning("lost the connection to the MQTT broker, reconnecting")
+
+    def _on_message(self, client, userdata, message):
+        try:
+            document = json.loads(message.payload)
+        except ValueError as e:
+            logging.warning("ignoring invalid JSON on %s: %s" % (message.topic, e))
+            return
+        if not isinstance(document, dict):
+            logging.warning("ignoring JSON on %s, it is not an object" % message.topic)
+            return
+
+        changes = decode(self._tree, document, {})
+        if not changes:
+            return
+        with self._lock:
+            schedule = not self._pending
+            self._pending.update(changes)
+        if schedule:
+            GLib.idle_add(self._apply)
+
+    # ==== called on the main loop ====
+
+    def _apply(self):
+        with self._lock:
+            changes, self._pending = self._pending, {}
+        self._callback(changes)
+        return False
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+from gi.repository import GLib
+import logging
+from time import monotonic
+
+
+class SenderRateLimiter:
+    """
+    Limits the writes of each D-Bus sender with a token bucket, that is refilled with `rate` tokens per
+    second up to `burst` tokens. Every written path costs one token.
+
+    A write without a token is not rejected but folded: only the latest value of each path is kept and
+    all folded values are passed to `callback` as one dict every `flush_interval` ms. A folded value that
+    is replaced by a newer one before it was applied counts as dropped.
+    """
+
+    # buckets of senders that did not write for this many seconds are removed
+    IDLE_TIMEOUT = 60
+
+    def __init__(self, rate, burst, flush_interval, callback):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.flush_interval = flush_interval
+        self._callback = callback
+        self._buckets = {}
+        self._folded = {}
+        self._timer = None
+
+        self.folded = 0
+        self.dropped = 0
+        self.folded_by_sender = {}
+
+    def allow(self, sender, path, value):
+        """
+        Returns True when the write can be applied right away, False when it was folded.
+        """
+        if sender is None:
+            return True
+
+        now = monotonic()
+        bucket = self._buckets.get(sender)
+        if bucket is None:
+            if len(self._buckets) >= 32:
+                self._remove_idle_buckets(now)
+            bucket = self._buckets[sender] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            # a newer value supersedes a folded one
+            if path in self._folded:
+                del self._folded[path]
+                self.dropped += 1
+            return True
+
+        if path in self._folded:
+            self.dropped += 1
+        self._folded[path] = value
+        self.folded += 1
+        self.folded_by_sender[sender] = self.folded_by_sender.get(sender, 0) + 1
+
+        if self._timer is None:
+            self._timer = GLib.timeout_add(self.flush_interval, self._flush)
+        return False
+
+    def top_sender(self):
+        """
+        Returns the sender with the most folded writes, or None.
+        """
+        if not self.folded_by_sender:
+            return None
+        return max(self.folded_by_sender, key=self.folded_by_sender.get)
+
+    def stop(self):
+        """
+        Cancels the flush timer and returns the folded values that were not applied yet.
+        """
+        if self._timer is not None:
+            GLib.source_remove(self._timer)
+            self._timer = None
+        folded, self._folded = self._folded, {}
+        return folded
+
+    def _flush(self):
+        self._timer = None
+        folded, self._folded = self._folded, {}
+        if folded:
+            logging.debug("applying %d folded writes" % len(folded))
+            self._callback(folded)
+        return False
+
+    def _remove_idle_buckets(self, now):
+        for sender, bucket in list(self._buckets.items()):
+            if now - bucket[1] > self.IDLE_TIMEOUT:
+                del self._buckets[sender]
+                # senders are mostly short lived unique names, keep only the counts of the recent ones
+                self.folded_by_sender.pop(sender, None)
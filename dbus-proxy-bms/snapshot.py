@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+from gi.repository import GLib
+import json
+import logging
+import os
+import queue
+import threading
+from time import monotonic
+
+
+class Snapshot:
+    """
+    Keeps the last known values of selected paths in a file, so that they can be restored after a restart.
+
+    A change does not write the file right away. The file is written `debounce` ms after the first
+    change, but not earlier than `interval` seconds after the previous write, with all changes up to
+    then. The file is written by a helper thread to a temporary file that then replaces the snapshot,
+    so the main loop never waits for the flash and a crash never leaves a half written snapshot.
+
+    @param filename  the file of the snapshot
+    @param prefixes  paths or path prefixes that are kept in the snapshot
+    """
+
+    def __init__(self, filename, prefixes, interval, debounce):
+        self.filename = filename
+        self.interval = interval
+        self.debounce = debounce
+        self._prefixes = [p.rstrip("/") for p in prefixes]
+        self._selected = {}
+        self._values = {}
+        self._timer = None
+        self._written = monotonic() - interval
+
+        # restored paths that were not written again since the restart
+        self.stale = set()
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="snapshot", daemon=True)
+        self._thread.start()
+
+    def selected(self, path):
+        try:
+            return self._selected[path]
+        except KeyError:
+            selected = any(path == p or path.startswith(p + "/") for p in self._prefixes)
+            self._selected[path] = selected
+            return selected
+
+    def load(self):
+        """
+        Returns the values of the snapshot, they are marked as stale until they are updated.
+        """
+        try:
+            with open(self.filename) as f:
+                values = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.error("could not read snapshot %s: %s" % (self.filename, e))
+            return {}
+
+        values = {path: value for path, value in values.items() if self.selected(path) and value is not None}
+        self._values.update(values)
+        self.stale = set(values)
+        return values
+
+    def update(self, path, value):
+        """
+        Records a new value of a path. Returns True when it confirmed a stale value. An invalidated path keeps
+        its last known value, so that it can still be restored.
+        """
+        if value is None or not self.selected(path):
+            return False
+
+        if self._values.get(path) != value:
+            self._values[path] = value
+            if self._timer is None:
+                wait = max(self.debounce / 1000, self._written + self.interval - monotonic())
+                self._timer = GLib.timeout_add(max(1, int(wait * 1000)), self._on_timer)
+
+        if path in self.stale:
+            self.stale.discard(path)
+            return True
+        return False
+
+    def _on_timer(self):
+        self._timer = None
+        self._written = monotonic()
+        self._queue.put(dict(self._values))
+        return False
+
+    def _run(self):
+        while True:
+            values = self._queue.get()
+            temp = self.filename + ".tmp"
+            try:
+                with open(temp, "w") as f:
+                    json.dump(values, f, sort_keys=True)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp, self.filename)
+                logging.debug("wrote snapshot with %d paths to %s" % (len(values), self.filename))
+            except (OSError, TypeError, ValueError) as e:
+                logging.error("could not write snapshot %s: %s" % (self.filename, e))
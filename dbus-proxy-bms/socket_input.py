@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""
+Binary input on a local Unix datagram socket, for writers that update values many times per second.
+
+Every path has an ID, its index in the path table. A writer asks for the table once by sending the
+single byte "?" from a bound socket, the reply contains the paths separated by newlines.
+
+A value frame contains:
+
+    uint8    frame type, 1
+    uint16   number of values N
+    uint16   N path IDs
+    float64  N values, NaN invalidates the path
+
+all in little endian. Values of paths with an integer format are converted to int, paths with a text
+value cannot be written.
+"""
+
+from gi.repository import GLib
+import logging
+import math
+import os
+import socket
+import struct
+
+FRAME_VALUES = 1
+HEADER = struct.Struct("<BH")
+
+
+class SocketInput:
+    """
+    Reads the frames on the main loop with GLib.io_add_watch and passes all values that arrived since
+    the last time to `callback` as one dict of path -> value.
+
+    @param paths  list of paths, the index is the ID of a path
+    @param types  dict with the type (int or float) of each path, paths without type cannot be written
+    """
+
+    def __init__(self, filename, paths, types, callback):
+        self.filename = filename
+        self.paths = list(paths)
+        self._callback = callback
+        self._convert = [types.get(path) for path in self.paths]
+        self._layouts = {}
+
+        if os.path.exists(filename):
+            os.unlink(filename)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(filename)
+        self._socket.setblocking(False)
+        self._table = "\n".join(self.paths).encode()
+
+        GLib.io_add_watch(self._socket.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._on_readable)
+        logging.info("listening for frames on %s" % filename)
+
+    def _layout(self, count):
+        # the struct of the IDs and values of a frame with `count` values, compiled once per count
+        layout = self._layouts.get(count)
+        if layout is None:
+            layout = self._layouts[count] = struct.Struct("<%dH%dd" % (count, count))
+        return layout
+
+    def _on_readable(self, fd, condition):
+        changes = {}
+        while True:
+            try:
+                data, address = self._socket.recvfrom(65536)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                logging.error("could not read from %s: %s" % (self.filename, e))
+                break
+
+            if data == b"?":
+                if address:
+                    try:
+                        self._socket.sendto(self._table, address)
+                    except OSError as e:
+                        logging.warning("could not send the path table to %s: %s" % (address, e))
+                continue
+
+            try:
+                self._decode(data, changes)
+            except (struct.error, ValueError, IndexError, OverflowError) as e:
+                logging.debug("ignoring invalid frame: %s" % e)
+
+        if changes:
+            self._callback(changes)
+        return True
+
+    def _decode(self, data, changes):
+        frame_type, count = HEADER.unpack_from(data)
+        if frame_type != FRAME_VALUES:
+            raise ValueError("unknown frame type %d" % frame_type)
+        layout = self._layout(count)
+        if len(data) != HEADER.size + layout.size:
+            raise ValueError("frame with %d values has %d bytes" % (count, len(data)))
+
+        fields = layout.unpack_from(data, HEADER.size)
+        paths = self.paths
+        convert = self._convert
+        frame = {}
+        for i in range(count):
+            path_id = fields[i]
+            value = fields[count + i]
+            if convert[path_id] is None:
+                continue
+            frame[paths[path_id]] = None if math.isnan(value) else convert[path_id](value)
+        # a frame is applied completely or not at all
+        changes.update(frame)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+from bisect import bisect
+from gi.repository import GLib
+import os
+from time import monotonic
+
+
+class ProxyStats:
+    """
+    Counts the work of the proxy and publishes the counters below /Proxy/Stats every `interval` ms.
+
+    Counting is a plain integer increment. The rates, the main loop lag and the RSS are only computed
+    when the counters are published, and all paths are published together in one batch.
+
+    The main loop lag is the delay of the publish timer: GLib can only dispatch it once the callbacks
+    that are running at that time returned.
+    """
+
+    # upper bounds in seconds of the callback latency buckets, the last bucket takes the rest
+    LATENCY_BOUNDS = (0.0001, 0.001, 0.01)
+    LATENCY_BUCKETS = ("Under100us", "Under1ms", "Under10ms", "Over10ms")
+
+    def __init__(self, service, interval):
+        self._service = service
+        self.interval = interval
+
+        self.filtered = 0
+        self.latency = [0] * len(self.LATENCY_BUCKETS)
+        self.max_lag = 0
+
+        self._last_writes = 0
+        self._last_signals = 0
+        self._last = monotonic()
+        self._pagesize = os.sysconf("SC_PAGE_SIZE") // 1024
+
+        for path in (
+            "/Proxy/Stats/Writes",
+            "/Proxy/Stats/WritesPerSecond",
+            "/Proxy/Stats/RejectedWrites",
+            "/Proxy/Stats/FilteredWrites",
+            "/Proxy/Stats/Signals",
+            "/Proxy/Stats/SignalsPerSecond",
+            "/Proxy/Stats/CoalescedChanges",
+            "/Proxy/Stats/GetItems/CacheHits",
+            "/Proxy/Stats/GetItems/Rebuilds",
+            "/Proxy/Stats/MainLoopLag",
+            "/Proxy/Stats/MaxMainLoopLag",
+            "/Proxy/Stats/Rss",
+        ):
+            service.add_path(path, None)
+        for bucket in self.LATENCY_BUCKETS:
+            service.add_path("/Proxy/Stats/CallbackLatency/" + bucket, 0)
+
+        GLib.timeout_add(interval, self._on_timer)
+
+    def written(self, accepted):
+        """
+        Counts a successful write of another process, `accepted` is False when it was folded or absorbed.
+        The writes themselves and the rejected ones are counted by the service.
+        """
+        if not accepted:
+            self.filtered += 1
+
+    def took(self, seconds):
+        self.latency[bisect(self.LATENCY_BOUNDS, seconds)] += 1
+
+    def _rss(self):
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * self._pagesize
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def _on_timer(self):
+        now = monotonic()
+        elapsed = now - self._last
+        # GLib schedules the next call `interval` ms after this one was dispatched
+        lag = max(0, int(elapsed * 1000 - self.interval))
+        self.max_lag = max(self.max_lag, lag)
+        self._last = now
+
+        root = self._service._dbusnodes["/"]
+        publisher = self._service.publisher
+        signals = root.signals
+        writes = sum(self._service.writes)
+
+        with self._service as s:
+            s["/Proxy/Stats/Writes"] = writes
+            s["/Proxy/Stats/WritesPerSecond"] = round((writes - self._last_writes) / elapsed, 1)
+            s["/Proxy/Stats/RejectedWrites"] = writes - self._service.writes[0]
+            s["/Proxy/Stats/FilteredWrites"] = self.filtered
+            s["/Proxy/Stats/Signals"] = signals
+            s["/Proxy/Stats/SignalsPerSecond"] = round((signals - self._last_signals) / elapsed, 1)
+            s["/Proxy/Stats/CoalescedChanges"] = (
+                publisher.staged - publisher.flushes if hasattr(publisher, "staged") else 0
+            )
+            s["/Proxy/Stats/GetItems/CacheHits"] = root.cache_hits
+            s["/Proxy/Stats/GetItems/Rebuilds"] = root.cache_rebuilds
+            s["/Proxy/Stats/MainLoopLag"] = lag
+            s["/Proxy/Stats/MaxMainLoopLag"] = self.max_lag
+            s["/Proxy/Stats/Rss"] = self._rss()
+            for bucket, count in zip(self.LATENCY_BUCKETS, self.latency):
+                s["/Proxy/Stats/CallbackLatency/" + bucket] = count
+
+        self._last_writes = writes
+        self._last_signals = signals
+        return True
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+from gi.repository import GLib
+import logging
+import os
+import sys
+import threading
+import traceback
+from time import monotonic, sleep, strftime
+
+
+class StallWatchdog:
+    """
+    Detects stalls of the GLib main loop. A timer on the main loop updates a heartbeat every `heartbeat`
+    ms and a helper thread checks it. When the heartbeat is older than `threshold` ms, the helper thread
+    logs the current stack of the main thread, so the log shows what the main loop was busy with. The
+    end of the stall is logged together with its duration.
+
+    The helper thread can also sample the stack of the main thread every `sample_interval` ms, see
+    SamplingProfiler.
+    """
+
+    def __init__(self, threshold, heartbeat=None, profiler=None):
+        self.threshold = threshold / 1000
+        self.heartbeat = (heartbeat or max(10, threshold // 4)) / 1000
+        self.profiler = profiler
+
+        self._beat = monotonic()
+        self._stalled_since = None
+        self._main = threading.main_thread().ident
+
+        GLib.timeout_add(int(self.heartbeat * 1000), self._on_heartbeat)
+        self._thread = threading.Thread(target=self._run, name="watchdog", daemon=True)
+        self._thread.start()
+
+    def _on_heartbeat(self):
+        self._beat = monotonic()
+        return True
+
+    def _main_frame(self):
+        return sys._current_frames().get(self._main)
+
+    def _run(self):
+        interval = self.heartbeat / 2
+        if self.profiler is not None:
+            interval = min(interval, self.profiler.interval)
+
+        while True:
+            sleep(interval)
+            now = monotonic()
+
+            if self.profiler is not None:
+                self.profiler.sample(self._main_frame(), now)
+
+            silent = now - self._beat
+            if silent > self.threshold + self.heartbeat:
+                if self._stalled_since is None:
+                    self._stalled_since = self._beat
+                    frame = self._main_frame()
+                    stack = "".join(traceback.format_stack(frame)) if frame is not None else "unknown\n"
+                    logging.warning(
+                        "main loop stalled for %d ms, main thread is at:\n%s" % (silent * 1000, stack.rstrip())
+                    )
+            elif self._stalled_since is not None:
+                logging.warning("main loop stall ended after %d ms" % ((self._beat - self._stalled_since) * 1000))
+                self._stalled_since = None
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for the main thread. Every sample counts the stack of the main thread, which
+    costs a few microseconds on the helper thread and nothing on the main thread. Every `report_interval`
+    seconds the stacks and functions that were seen most often are written to `filename`, replacing
+    the previous report.
+    """
+
+    # number of innermost frames of a stack that are counted
+    DEPTH = 8
+    # number of stacks and functions in the report
+    TOP = 20
+
+    def __init__(self, interval, report_interval, filename):
+        self.interval = interval / 1000
+        self.report_interval = report_interval
+        self.filename = filename
+        self._stacks = {}
+        self._functions = {}
+        self._samples = 0
+        self._since = monotonic()
+        self._started = strftime("%Y-%m-%d %H:%M:%S")
+
+    def sample(self, frame, now):
+        if frame is not None:
+            stack = []
+            while frame is not None and len(stack) < self.DEPTH:
+                code = frame.f_code
+                stack.append((code.co_filename, frame.f_lineno, code.co_name))
+                frame = frame.f_back
+            stack = tuple(stack)
+            self._stacks[stack] = self._stacks.get(stack, 0) + 1
+            function = stack[0][0], stack[0][2]
+            self._functions[function] = self._functions.get(function, 0) + 1
+            self._samples += 1
+
+        if now - self._since >= self.report_interval:
+            self._report(now)
+
+    def _report(self, now):
+        stacks, self._stacks = self._stacks, {}
+        functions, self._functions = self._functions, {}
+        samples, self._samples = self._samples, 0
+        seconds = now - self._since
+        self._since = now
+
+        lines = [
+            "%d samples in %.0f seconds, every %d ms, since %s" % (samples, seconds, self.interval * 1000, self._started),
+            "",
+            "functions:",
+        ]
+        for (filename, name), count in sorted(functions.items(), key=lambda f: -f[1])[: self.TOP]:
+            lines.append("%6.1f%%  %s (%s)" % (count * 100 / max(1, samples), name, os.path.basename(filename)))
+
+        lines.append("")
+        lines.append("stacks, innermost frame first:")
+        for stack, count in sorted(stacks.items(), key=lambda s: -s[1])[: self.TOP]:
+            lines.append("%6.1f%%" % (count * 100 / max(1, samples)))
+            for filename, lineno, name in stack:
+                lines.append("         %s:%d %s" % (os.path.basename(filename), lineno, name))
+
+        self._started = strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            temp = self.filename + ".tmp"
+            with open(temp, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(temp, self.filename)
+        except OSError as e:
+            logging.error("could not write profile to %s: %s" % (self.filename, e))